@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+
+# compressed copies of every tournament page and GPX file we fetch from HSQB,
+# so changes to the parser can be rerun over the whole history without
+# touching the network (see scraper.getTournament's offline mode)
+#
+# files are stored once per distinct content, gzipped, under
+# ARCHIVE_DIR/objects/<first 2 hex digits of sha256>/<sha256>.gz, and
+# ARCHIVE_DIR/index.db records which tournament each one came from
+
+import gzip
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+# set to None to stop archiving
+ARCHIVE_DIR = 'archive'
+
+# sqlite connections can't be shared between threads
+_local = threading.local()
+
+def _connect():
+	conn = getattr(_local, 'conn', None)
+	if conn is None:
+		os.makedirs(os.path.join(ARCHIVE_DIR, 'objects'), exist_ok=True)
+		conn = sqlite3.connect(os.path.join(ARCHIVE_DIR, 'index.db'),
+		                       timeout=30)
+		conn.execute('CREATE TABLE IF NOT EXISTS versions ('
+		             'tid INTEGER NOT NULL, '
+		             'kind TEXT NOT NULL, '
+		             'hash TEXT NOT NULL, '
+		             'fetched REAL NOT NULL, '
+		             'PRIMARY KEY (tid, kind, hash))')
+		conn.commit()
+		_local.conn = conn
+	return conn
+
+def _objectPath(digest):
+	return os.path.join(ARCHIVE_DIR, 'objects', digest[:2], digest + '.gz')
+
+# saves text fetched for a tournament; kind is 'page' or 'gpx'
+def store(tid, kind, text):
+	if not ARCHIVE_DIR:
+		return
+
+	data = text.encode('utf-8')
+	digest = hashlib.sha256(data).hexdigest()
+	path = _objectPath(digest)
+	try:
+		if not os.path.exists(path):
+			os.makedirs(os.path.dirname(path), exist_ok=True)
+			# write to a temporary file first so readers never see half of it
+			tmpPath = path + '.' + str(os.getpid()) + '.'\
+			          + str(threading.get_ident()) + '.tmp'
+			with open(tmpPath, 'wb') as outfile:
+				outfile.write(gzip.compress(data, 9, mtime=0))
+			os.replace(tmpPath, path)
+
+		conn = _connect()
+		conn.execute('INSERT OR REPLACE INTO versions '
+		             '(tid, kind, hash, fetched) VALUES (?, ?, ?, ?)',
+		             (tid, kind, digest, time.time()))
+		conn.commit()
+	except (OSError, sqlite3.Error) as e:
+		# losing an archive copy isn't worth failing a scrape over
+		logging.error('could not archive ' + kind + ' for tournament '\
+		              + str(tid) + ': ' + str(e))
+
+# returns the most recently archived text for a tournament, or None
+def load(tid, kind):
+	if not ARCHIVE_DIR:
+		return None
+
+	row = _connect().execute('SELECT hash FROM versions '
+	                         'WHERE tid = ? AND kind = ? '
+	                         'ORDER BY fetched DESC LIMIT 1',
+	                         (tid, kind)).fetchone()
+	if not row:
+		return None
+
+	with open(_objectPath(row[0]), 'rb') as infile:
+		return gzip.decompress(infile.read()).decode('utf-8')
+
+# all tournament IDs with an archived page, in order
+def tournamentIDs():
+	if not ARCHIVE_DIR or not os.path.exists(os.path.join(ARCHIVE_DIR,
+	                                                      'index.db')):
+		return []
+
+	rows = _connect().execute('SELECT DISTINCT tid FROM versions '
+	                          'WHERE kind = \'page\' ORDER BY tid')
+	return [r[0] for r in rows]
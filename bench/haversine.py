@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+
+# compares the ways we can match tournaments against circular notifications:
+# the original double loop over surfDist, the grid index, and the numpy kernel
+#
+# usage: python3 bench/haversine.py [tournaments] [notifications]
+
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import spatial
+from spatial import surfDist, EARTH_RADIUS
+
+# random points in the continental US, where nearly everything is
+def randomPoint():
+	return (random.uniform(25, 49), random.uniform(-125, -67))
+
+def naive(points, centers, radii):
+	return {(i, j) for i, p in enumerate(points)
+	        for j, c in enumerate(centers)
+	        if surfDist(EARTH_RADIUS, c, p) < radii[j]}
+
+def indexed(points, centers, radii):
+	index = spatial.CircleIndex()
+	for j, c in enumerate(centers):
+		index.add(c[0], c[1], radii[j], j)
+
+	return {(i, j) for i, p in enumerate(points)
+	        for j, r in index.query(*p)
+	        if surfDist(EARTH_RADIUS, centers[j], p) < r}
+
+def batch(points, centers, radii):
+	return set(spatial.batchWithin(EARTH_RADIUS, points, centers, radii))
+
+def timeit(func, *args):
+	start = time.perf_counter()
+	result = func(*args)
+	return result, time.perf_counter() - start
+
+if __name__ == '__main__':
+	nTourneys = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+	nNotes = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+
+	random.seed(0)
+	points = [randomPoint() for i in range(nTourneys)]
+	centers = [randomPoint() for j in range(nNotes)]
+	radii = [spatial.toMeters(random.uniform(10, 200), 'mi')
+	         for j in range(nNotes)]
+
+	print(str(nTourneys) + ' tournaments x ' + str(nNotes)
+	      + ' notifications')
+
+	expected, tNaive = timeit(naive, points, centers, radii)
+	print('  naive:   %8.3f s  (%d matches)' % (tNaive, len(expected)))
+
+	got, tIndex = timeit(indexed, points, centers, radii)
+	assert got == expected
+	print('  indexed: %8.3f s  (%.1fx)' % (tIndex, tNaive / tIndex))
+
+	if spatial.np is None:
+		print('  batch:   numpy not installed')
+	else:
+		got, tBatch = timeit(batch, points, centers, radii)
+		assert got == expected
+		print('  batch:   %8.3f s  (%.1fx)' % (tBatch, tNaive / tBatch))
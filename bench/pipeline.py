@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+
+# times the scrape/notify pipeline end to end without the network: fetching
+# and parsing tournaments from bench/stub.py with getAllTournaments, matching
+# synthetic tournaments against synthetic notifications with the matcher
+# scrapeAndNotify uses, and rendering the resulting emails
+#
+# the stub runs on 127.0.0.1, which isn't in throttle.LIMITS, so the scraper
+# isn't rate limited here the way it is against hsquizbowl.org
+#
+# usage: python3 bench/pipeline.py [IDs] [notifications] [tournaments]
+#                                  [latency in ms]
+
+import logging
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+from datetime import datetime, timedelta
+
+# keep the log quiet (this has to happen before qbnotify sets up its own)
+logging.basicConfig(level=logging.WARNING)
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, root)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+# the example secrets are fine, since nothing real gets contacted
+try:
+	import mysecrets
+except ImportError:
+	import importlib.machinery
+	import importlib.util
+	loader = importlib.machinery.SourceFileLoader(
+		'mysecrets', os.path.join(root, 'mysecrets.py.example'))
+	spec = importlib.util.spec_from_loader('mysecrets', loader)
+	mysecrets = importlib.util.module_from_spec(spec)
+	loader.exec_module(mysecrets)
+	sys.modules['mysecrets'] = mysecrets
+
+# everything the benchmark writes goes in a scratch directory
+scratch = tempfile.mkdtemp(prefix='qbnotify-bench-')
+os.environ['QBNOTIFY_DB'] = 'sqlite:///' + os.path.join(scratch, 'bench.db')
+
+import archive
+import digest
+import geocache
+import scraper
+import spatial
+import stub
+
+archive.ARCHIVE_DIR = None
+geocache.CACHE_FILE = os.path.join(scratch, 'geocache.db')
+
+def percentile(values, p):
+	values = sorted(values)
+	if not values: return 0.0
+	return values[min(len(values) - 1, int(p / 100 * len(values)))]
+
+# every request the scraper makes, as (url, seconds)
+requests = []
+
+def _timedGet(url, **kwargs):
+	start = time.perf_counter()
+	resp = _httpGet(url, **kwargs)
+	requests.append((url, time.perf_counter() - start))
+	return resp
+
+_httpGet = scraper.httpGet
+scraper.httpGet = _timedGet
+
+# every run starts with an empty geocode cache, so worker counts are compared
+# on equal terms. connections are kept per thread, so the old ones go too
+def coldGeocache(name):
+	geocache.CACHE_FILE = os.path.join(scratch, 'geocache-' + name + '.db')
+	geocache._local = threading.local()
+
+def benchScrape(nIDs, workers):
+	coldGeocache('workers' + str(workers))
+	del requests[:]
+	start = time.perf_counter()
+	found = sum(1 for t in scraper.getAllTournaments(1, nIDs, workers))
+	elapsed = time.perf_counter() - start
+
+	latencies = [t for url, t in requests]
+	geocodes = sum(1 for url, t in requests if 'geocode' in url)
+	print('  workers=%-3d %8.3f s  %7.1f IDs/s  %5d found  %5d requests '
+	      '(%d geocode)  p50 %.1f ms  p95 %.1f ms  p99 %.1f ms'
+	      % (workers, elapsed, nIDs / elapsed, found, len(requests),
+	         geocodes, 1000 * percentile(latencies, 50),
+	         1000 * percentile(latencies, 95),
+	         1000 * percentile(latencies, 99)))
+
+# random points in the continental US, where nearly everything is
+def randomPoint():
+	return (random.uniform(25, 49), random.uniform(-125, -67))
+
+STATES = ['VA', 'MD', 'NY', 'CA', 'TX', 'IL', 'OH', 'ON', 'UK', 'Online']
+
+def makeNotifications(q, n):
+	notes = []
+	for k in range(n):
+		email = 'user' + str(k // 3) + '@example.com'
+		if random.random() < 0.5:
+			note = q.Notification(email=email, id=k % 3, type='S',
+			                      state=random.choice(STATES))
+		else:
+			lat, lon = randomPoint()
+			note = q.Notification(email=email, id=k % 3, type='C', lat=lat,
+			                      lon=lon, radius=random.uniform(10, 200),
+			                      unit='mi')
+		note.diffs = random.randrange(1, 32)
+		notes.append(note)
+	q.db.session.add_all(notes)
+	q.db.session.commit()
+
+def makeTournaments(n):
+	today = datetime.today()
+	tourneys = []
+	for tid in range(n):
+		t = scraper.Tournament()
+		t.id = tid
+		t.name = 'Tournament ' + str(tid)
+		t.date = today + timedelta(days=random.randint(1, 365))
+		t.level = random.choice('MHCOT')
+		t.state = random.choice(STATES)
+		t.position = randomPoint()
+		tourneys.append(t)
+	return tourneys
+
+def benchMatch(q, tourneys, useNumpy):
+	saved = spatial.np, q.app.config['BATCH_MATCH_THRESHOLD']
+	if not useNumpy:
+		spatial.np = None
+	q.app.config['BATCH_MATCH_THRESHOLD'] = 200 if useNumpy else None
+
+	start = time.perf_counter()
+	matcher = q.StreamMatcher(datetime.today())
+	for t in tourneys:
+		matcher.add(t)
+	toSend = matcher.finish()
+	elapsed = time.perf_counter() - start
+
+	spatial.np, q.app.config['BATCH_MATCH_THRESHOLD'] = saved
+	matches = sum(len(ids) for ids in toSend.values())
+	print('  %-8s %8.3f s  %9.1f tournaments/s  %7d matches  %5d emails'
+	      % ('numpy' if useNumpy else 'index', elapsed,
+	         len(tourneys) / elapsed, matches, len(toSend)))
+	return toSend
+
+def benchRender(tourneys, toSend):
+	byID = {t.id: t for t in tourneys}
+	times = []
+	renderer = digest.DigestRenderer()
+
+	start = time.perf_counter()
+	for email in toSend:
+		t = time.perf_counter()
+		renderer.render([byID[tid] for tid in toSend[email]])
+		times.append(time.perf_counter() - t)
+	elapsed = time.perf_counter() - start
+
+	print('  %8.3f s  %9.1f emails/s  p50 %.3f ms  p99 %.3f ms'
+	      % (elapsed, len(toSend) / elapsed if elapsed else 0,
+	         1000 * percentile(times, 50), 1000 * percentile(times, 99)))
+
+if __name__ == '__main__':
+	nIDs = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+	nNotes = int(sys.argv[2]) if len(sys.argv) > 2 else 20000
+	nTourneys = int(sys.argv[3]) if len(sys.argv) > 3 else 5000
+	latency = float(sys.argv[4]) / 1000 if len(sys.argv) > 4 else 0.02
+
+	random.seed(0)
+	proc, base = stub.start(maxID=nIDs, latency=latency)
+	scraper.HSQB_URL = base + '/db/tournaments/'
+	scraper.GEOCODE_URL = base + '/geocode/json'
+
+	print('getAllTournaments: ' + str(nIDs) + ' IDs, '
+	      + str(int(latency * 1000)) + ' ms latency (geocache cold every run, '
+	      'not rate limited)')
+	for workers in [1, 8, 32]:
+		benchScrape(nIDs, workers)
+	proc.terminate()
+
+	import qbnotify as q
+	with q.app.app_context():
+		q.db.create_all()
+		makeNotifications(q, nNotes)
+		tourneys = makeTournaments(nTourneys)
+
+		print('matching: ' + str(nTourneys) + ' tournaments x '
+		      + str(nNotes) + ' notifications')
+		toSend = benchMatch(q, tourneys, False)
+		if spatial.np is not None:
+			assert benchMatch(q, tourneys, True) == toSend
+
+	print('rendering: ' + str(len(toSend)) + ' emails')
+	benchRender(tourneys, toSend)
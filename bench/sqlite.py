@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+
+# measures the queries the site and the matcher make against a synthetic copy
+# of qbnotify.db, with and without the indexes qbnotify.py declares and the
+# pragmas it sets on startup. also checks whether a reader has to wait while a
+# scrape holds a write transaction
+#
+# usage: python3 bench/sqlite.py [users] [tournaments]
+
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+from datetime import datetime, timedelta
+
+SCHEMA = [
+	'CREATE TABLE notification (email VARCHAR(255) NOT NULL, '
+	'id INTEGER NOT NULL, type VARCHAR(1), diffs INTEGER NOT NULL, '
+	'lat FLOAT, lon FLOAT, radius FLOAT, unit VARCHAR(8), '
+	'state VARCHAR(16), dispname VARCHAR(255), PRIMARY KEY (email, id))',
+	'CREATE TABLE db_tournament (id INTEGER NOT NULL PRIMARY KEY, '
+	'name VARCHAR(256), date DATETIME, level VARCHAR(8), '
+	'state VARCHAR(16), lat FLOAT, lon FLOAT)',
+]
+
+INDEXES = [
+	'CREATE INDEX ix_db_tournament_date ON db_tournament (date)',
+]
+
+PRAGMAS = [
+	'PRAGMA journal_mode=WAL',
+	'PRAGMA synchronous=NORMAL',
+	'PRAGMA cache_size=-20000',
+	'PRAGMA mmap_size=268435456',
+]
+
+STATES = ['VA', 'MD', 'NY', 'CA', 'TX', 'IL', 'OH', 'ON', 'UK', 'Online']
+
+def build(path, nUsers, nTourneys, tuned):
+	conn = sqlite3.connect(path)
+	if tuned:
+		for p in PRAGMAS: conn.execute(p)
+	for s in SCHEMA: conn.execute(s)
+	if tuned:
+		for s in INDEXES: conn.execute(s)
+
+	random.seed(0)
+	notes = []
+	for u in range(nUsers):
+		email = 'user' + str(u) + '@example.com'
+		for i in range(3):
+			if random.random() < 0.5:
+				notes.append((email, i, 'S', random.randrange(1, 32), None,
+				              None, None, None, random.choice(STATES), None))
+			else:
+				notes.append((email, i, 'C', random.randrange(1, 32),
+				              random.uniform(25, 49), random.uniform(-125, -67),
+				              random.uniform(10, 200), 'mi', None, None))
+	conn.executemany('INSERT INTO notification VALUES '
+	                 '(?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', notes)
+
+	start = datetime(2015, 1, 1)
+	tourneys = [(t, 'Tournament ' + str(t),
+	             (start + timedelta(days=t * 4000 / nTourneys)).isoformat(' '),
+	             random.choice('MHCOT'), random.choice(STATES),
+	             random.uniform(25, 49), random.uniform(-125, -67))
+	            for t in range(nTourneys)]
+	conn.executemany('INSERT INTO db_tournament VALUES '
+	                 '(?, ?, ?, ?, ?, ?, ?)', tourneys)
+	conn.commit()
+	conn.execute('ANALYZE')
+	return conn
+
+# the same queries qbnotify.py makes (home page, StreamMatcher, updateListings
+# and mapIndex, onlineListing, rescanUpcoming)
+QUERIES = [
+	('home page', 'SELECT * FROM notification WHERE email = ? ORDER BY id',
+	 lambda: ('user' + str(random.randrange(1000)) + '@example.com',)),
+	('state load', 'SELECT email, state, diffs FROM notification '
+	 'WHERE type = \'S\' AND diffs != 0', lambda: ()),
+	('circle load', 'SELECT email, lat, lon, diffs, radius, unit '
+	 'FROM notification WHERE type = \'C\'', lambda: ()),
+	('upcoming.json', 'SELECT * FROM db_tournament WHERE date >= ? '
+	 'AND state != \'Online\' ORDER BY id', lambda: ('2025-06-01',)),
+	('online listing', 'SELECT * FROM db_tournament WHERE date >= ? '
+	 'AND state = \'Online\' ORDER BY level, date', lambda: ('2025-06-01',)),
+	('rescan', 'SELECT * FROM db_tournament WHERE date >= ? ORDER BY date',
+	 lambda: ('2025-06-01',)),
+]
+
+def timeQuery(conn, sql, argFunc, reps):
+	random.seed(1)
+	start = time.perf_counter()
+	for r in range(reps):
+		conn.execute(sql, argFunc()).fetchall()
+	return (time.perf_counter() - start) / reps * 1000
+
+# how long a reader waits while another connection holds a write transaction
+# (the writer's cache is kept small so the transaction spills to disk, like a
+# long scrape does)
+def readerWait(path):
+	writer = sqlite3.connect(path, isolation_level=None)
+	writer.execute('PRAGMA cache_size=10')
+	writer.execute('BEGIN IMMEDIATE')
+	writer.execute('UPDATE db_tournament SET name = name || \'x\'')
+
+	waited = []
+	def read():
+		reader = sqlite3.connect(path, timeout=10)
+		start = time.perf_counter()
+		reader.execute('SELECT count(*) FROM notification').fetchall()
+		waited.append(time.perf_counter() - start)
+
+	thread = threading.Thread(target=read)
+	thread.start()
+	time.sleep(1.0)
+	writer.execute('COMMIT')
+	thread.join()
+	return waited[0] * 1000
+
+if __name__ == '__main__':
+	nUsers = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+	nTourneys = int(sys.argv[2]) if len(sys.argv) > 2 else 20000
+
+	print(str(nUsers) + ' users (x3 notifications), '
+	      + str(nTourneys) + ' tournaments; ms per query')
+	print('%-16s %10s %10s' % ('query', 'default', 'tuned'))
+
+	with tempfile.TemporaryDirectory() as tmp:
+		paths = [os.path.join(tmp, 'default.db'), os.path.join(tmp, 'tuned.db')]
+		conns = [build(paths[0], nUsers, nTourneys, False),
+		         build(paths[1], nUsers, nTourneys, True)]
+
+		for name, sql, argFunc in QUERIES:
+			reps = 20 if name.endswith(' load') else 200
+			times = [timeQuery(c, sql, argFunc, reps) for c in conns]
+			print('%-16s %10.3f %10.3f' % (name, times[0], times[1]))
+
+		for c in conns: c.close()
+		waits = [readerWait(p) for p in paths]
+		print('%-16s %10.3f %10.3f' % ('read mid-scrape', waits[0], waits[1]))
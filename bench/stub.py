@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+
+# a stand-in for hsquizbowl.org and the geocoding API, so the scraper can be
+# benchmarked without touching the network. tournament pages, GPX files,
+# dbstats.php, and geocoding results are all made up from the tournament ID
+# (or the address), so every run sees the same data. every response waits
+# latency seconds first, like a real server would
+#
+# usage: python3 bench/stub.py [port] [max ID] [latency in ms]
+# then point scraper.HSQB_URL at http://localhost:<port>/db/tournaments/ and
+# scraper.GEOCODE_URL at http://localhost:<port>/geocode/json
+
+import hashlib
+import json
+import multiprocessing
+import random
+import socket
+import sys
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+LEVELS = ['Middle School', 'High School', 'College', 'Open', 'Trash']
+
+# places the geocoder knows about: (name, lat, lon, state, country)
+PLACES = [
+	('Springfield, IL', 39.80, -89.64, 'IL', 'US'),
+	('Richmond, VA', 37.54, -77.44, 'VA', 'US'),
+	('Columbus, OH', 39.96, -83.00, 'OH', 'US'),
+	('Austin, TX', 30.27, -97.74, 'TX', 'US'),
+	('Sacramento, CA', 38.58, -121.49, 'CA', 'US'),
+	('Albany, NY', 42.65, -73.75, 'NY', 'US'),
+	('Toronto, ON', 43.65, -79.38, 'ON', 'CA'),
+	('Oxford', 51.75, -1.26, None, 'GB'),
+]
+
+# every random choice about a tournament comes from its ID
+def _rng(key):
+	return random.Random(hashlib.sha256(str(key).encode()).digest())
+
+# what kind of tournament each ID is: None (doesn't exist), 'gpx' (has a
+# waypoint), 'address' (needs geocoding), or 'online'
+def kind(tid):
+	r = _rng(tid).random()
+	if r < 0.1: return None
+	elif r < 0.6: return 'gpx'
+	elif r < 0.9: return 'address'
+	return 'online'
+
+def makePage(tid):
+	k = kind(tid)
+	if k is None:
+		return '<html><body><div class="FBError">No such tournament.</div>'\
+		       '</body></html>'
+
+	r = _rng(tid)
+	level = r.choice(LEVELS)
+	date = time.strftime('%B %d, %Y', time.gmtime(
+		time.time() + r.randint(-400, 400) * 86400))
+	place = r.choice(PLACES)
+	if k == 'online':
+		address = 'Online'
+	else:
+		address = str(r.randint(1, 9999)) + ' Main St, ' + place[0]
+
+	fields = [('Host location:', place[0] if k != 'online' else 'Online'),
+	          ('Address:', address),
+	          ('Contact:', 'Director ' + str(tid)),
+	          ('Field limit:', str(r.randint(8, 48)) + ' teams')]
+	body = ''.join('<p><span class="FieldName">' + label + '</span> '
+	               + value + '</p>\n' for label, value in fields)
+
+	# pad it out to about the size of a real page
+	filler = '<p>' + 'Lorem ipsum dolor sit amet. ' * 20 + '</p>\n'
+	return '<html><head><title>Tournament ' + str(tid) + '</title></head>'\
+	       '<body><div class="MultilineHeading"><h2>Tournament '\
+	       + str(tid) + '</h2><h5>' + level + ' tournament on ' + date\
+	       + '</h5></div>\n' + body + filler * 10 + '</body></html>'
+
+def makeGPX(tid):
+	gpx = '<?xml version="1.0" encoding="UTF-8"?>\n'\
+	      '<gpx version="1.1" xmlns="http://www.topografix.com/GPX/1/1">'
+	if kind(tid) == 'gpx':
+		r = _rng(tid)
+		place = r.choice(PLACES)
+		gpx += '<wpt lat="' + str(place[1] + r.uniform(-0.5, 0.5))\
+		       + '" lon="' + str(place[2] + r.uniform(-0.5, 0.5))\
+		       + '"><name>Tournament ' + str(tid) + '</name></wpt>'
+	return gpx + '</gpx>'
+
+def makeGeocode(address):
+	place = _rng(address.lower()).choice(PLACES)
+	for p in PLACES:
+		if p[0].lower() in address.lower():
+			place = p
+
+	components = [{'short_name': place[4], 'types': ['country']}]
+	if place[3]:
+		components.insert(0, {'short_name': place[3],
+		                      'types': ['administrative_area_level_1']})
+	return json.dumps({'status': 'OK', 'results': [{
+		'geometry': {'location': {'lat': place[1], 'lng': place[2]}},
+		'address_components': components}]})
+
+class StubHandler(BaseHTTPRequestHandler):
+	# set by serve()
+	maxID = 10000
+	latency = 0.0
+
+	# keep-alive, with headers and body going out without a delayed ACK
+	# between them, like a real server
+	protocol_version = 'HTTP/1.1'
+	disable_nagle_algorithm = True
+
+	def do_GET(self):
+		time.sleep(self.latency)
+		url = urlparse(self.path)
+		parts = url.path.strip('/').split('/')
+
+		ctype = 'text/html'
+		if url.path == '/db/tournaments/dbstats.php':
+			body = 'count=' + str(self.maxID) + '&max=' + str(self.maxID)
+		elif url.path == '/geocode/json':
+			address = parse_qs(url.query).get('address', [''])[0]
+			body = makeGeocode(address)
+			ctype = 'application/json'
+		elif parts[:2] == ['db', 'tournaments'] and len(parts) >= 3\
+		     and parts[2].isdigit() and int(parts[2]) <= self.maxID:
+			tid = int(parts[2])
+			if parts[3:] == ['gpx']:
+				body = makeGPX(tid)
+				ctype = 'application/gpx+xml'
+			else:
+				body = makePage(tid)
+		else:
+			self.send_error(404)
+			return
+
+		data = body.encode('utf-8')
+		self.send_response(200)
+		self.send_header('Content-Type', ctype + '; charset=utf-8')
+		self.send_header('Content-Length', str(len(data)))
+		self.end_headers()
+		self.wfile.write(data)
+
+	def log_message(self, format, *args):
+		pass
+
+def serve(port, maxID, latency):
+	StubHandler.maxID = maxID
+	StubHandler.latency = latency
+	server = ThreadingHTTPServer(('127.0.0.1', port), StubHandler)
+	server.daemon_threads = True
+	server.serve_forever()
+
+# runs the stub in its own process (so it doesn't fight the benchmark for
+# the GIL) and returns (process, base URL)
+def start(port=8765, maxID=10000, latency=0.0):
+	proc = multiprocessing.Process(target=serve, args=(port, maxID, latency),
+	                               daemon=True)
+	proc.start()
+
+	# wait for it to come up
+	for i in range(100):
+		try:
+			socket.create_connection(('127.0.0.1', port), 0.1).close()
+			break
+		except OSError:
+			time.sleep(0.05)
+	return proc, 'http://127.0.0.1:' + str(port)
+
+if __name__ == '__main__':
+	port = int(sys.argv[1]) if len(sys.argv) > 1 else 8765
+	maxID = int(sys.argv[2]) if len(sys.argv) > 2 else 10000
+	latency = float(sys.argv[3]) / 1000 if len(sys.argv) > 3 else 0.0
+	print('serving on http://127.0.0.1:' + str(port))
+	serve(port, maxID, latency)
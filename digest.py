@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+
+# html for notification emails. kept separate from qbnotify.py so it can be
+# used (and benchmarked) without a database
+
+import html
+
+TOURNAMENT_URL = 'http://hsquizbowl.org/db/tournaments/'
+
+# link to a tournament, followed by its date (or preceded, if swap is set)
+def tournamentHTML(tid, name, date, swap=False):
+	part1 = '<a href="' + TOURNAMENT_URL + str(tid) + '">'
+	part1 += html.escape(name) + '</a>'
+	part2 = date.isoformat().split('T')[0]
+	if not swap:
+		return part1 + ' on ' + part2
+	else:
+		return part2 + ': ' + part1
+
+# builds email bodies for lists of tournaments. lots of people get exactly
+# the same tournaments (everyone watching the same state and level, say), so
+# each tournament is rendered once and each distinct body is built once, no
+# matter how many people it goes to. use one of these per run
+class DigestRenderer:
+	def __init__(self):
+		self.fragments = {}
+		self.bodies = {}
+
+	def _fragment(self, tourney):
+		if tourney.id not in self.fragments:
+			self.fragments[tourney.id] = tournamentHTML(tourney.id,
+			                                            tourney.name,
+			                                            tourney.date)
+		return self.fragments[tourney.id]
+
+	# tourneys is any collection of objects with id, name, and date
+	def render(self, tourneys):
+		ordered = sorted(tourneys, key=lambda t: (t.date, t.id))
+		key = tuple(t.id for t in ordered)
+		if key in self.bodies:
+			return self.bodies[key]
+
+		content = 'The following tournaments have recently been '\
+		          'posted to the hsquizbowl.org database:<br />'
+		for tourney in ordered:
+			content += '<br />' + self._fragment(tourney)
+
+		content += '<br /><br />'
+		content += 'You can edit your notification settings '
+		content += 'or view a map of all upcoming tournaments at '
+		content += '<a href="https://qbnotify.msmitchell.org">'
+		content += 'qbnotify.msmitchell.org'
+		content += '</a>.'
+
+		self.bodies[key] = content
+		return content
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+
+# persistent on-disk cache for geocoding results, so venues that show up in
+# tournament after tournament (and users re-entering the same address) don't
+# cost us an API query and a round trip every time
+
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+# set to None to disable caching entirely
+CACHE_FILE = 'geocache.db'
+
+# how long successful and failed lookups are remembered, in seconds
+# (failures expire sooner in case google learns about the address)
+HIT_TTL = 180 * 24 * 3600
+MISS_TTL = 7 * 24 * 3600
+
+# least recently used entries are evicted beyond this size
+MAX_ENTRIES = 50000
+
+# we only bother evicting every so often
+EVICT_INTERVAL = 100
+
+# sqlite connections can't be shared between threads
+_local = threading.local()
+_storeCount = 0
+
+def _connect():
+	conn = getattr(_local, 'conn', None)
+	if conn is None:
+		conn = sqlite3.connect(CACHE_FILE, timeout=30)
+		conn.execute('CREATE TABLE IF NOT EXISTS geocode ('
+		             'query TEXT PRIMARY KEY, '
+		             'result TEXT, '
+		             'expires REAL NOT NULL, '
+		             'accessed REAL NOT NULL)')
+		conn.execute('CREATE INDEX IF NOT EXISTS geocode_accessed '
+		             'ON geocode (accessed)')
+		conn.commit()
+		_local.conn = conn
+	return conn
+
+# queries that only differ in case or spacing share an entry
+def normalize(query):
+	return ' '.join(query.lower().split())
+
+# returns (True, result) if the query is cached, where result is None for a
+# cached failure, or (False, None) if we need to ask google
+def lookup(query):
+	if not CACHE_FILE:
+		return (False, None)
+
+	key = normalize(query)
+	now = time.time()
+	try:
+		conn = _connect()
+		row = conn.execute('SELECT result, expires FROM geocode '
+		                   'WHERE query = ?', (key,)).fetchone()
+		if not row or row[1] < now:
+			return (False, None)
+
+		conn.execute('UPDATE geocode SET accessed = ? WHERE query = ?',
+		             (now, key))
+		conn.commit()
+	except sqlite3.Error as e:
+		# a broken cache shouldn't break geocoding
+		logging.error('geocode cache lookup failed: ' + str(e))
+		return (False, None)
+
+	if row[0] is None:
+		return (True, None)
+	return (True, json.loads(row[0]))
+
+# remember a result; pass None to remember that the query failed
+def store(query, result):
+	global _storeCount
+	if not CACHE_FILE:
+		return
+
+	now = time.time()
+	if result is None:
+		value = None
+		expires = now + MISS_TTL
+	else:
+		value = json.dumps(result)
+		expires = now + HIT_TTL
+
+	try:
+		conn = _connect()
+		conn.execute('INSERT OR REPLACE INTO geocode '
+		             '(query, result, expires, accessed) '
+		             'VALUES (?, ?, ?, ?)',
+		             (normalize(query), value, expires, now))
+
+		_storeCount += 1
+		if _storeCount % EVICT_INTERVAL == 0:
+			_evict(conn, now)
+
+		conn.commit()
+	except sqlite3.Error as e:
+		logging.error('geocode cache store failed: ' + str(e))
+
+def _evict(conn, now):
+	conn.execute('DELETE FROM geocode WHERE expires < ?', (now,))
+	conn.execute('DELETE FROM geocode WHERE query IN '
+	             '(SELECT query FROM geocode ORDER BY accessed DESC '
+	             'LIMIT -1 OFFSET ?)', (MAX_ENTRIES,))
@@ -1,8 +1,21 @@
 #!/usr/bin/env python3
 
+import time
+
 import requests
 import mysecrets
 
+# seconds between status checks
+POLL_INTERVAL = 10
+
+# give up on the job after this many seconds (a job whose worker died is
+# handed to another one after the lease runs out, but if no worker is running
+# at all, nothing will ever pick it up)
+TIMEOUT = 6 * 60 * 60
+
+# seconds to wait for the server to answer a request
+REQUEST_TIMEOUT = 60
+
 # get ID of last tournament parsed
 try:
 	f = open('lastID', 'r')
@@ -16,28 +29,55 @@ except ValueError:
 	quit(1)
 
 # tell server to parse tournaments and notify people
-url = 'http://localhost:' + str(mysecrets.local_port) + '/sn'
-url += '?key=' + mysecrets.admin_key + '&start=' + str(last + 1)
-resp = requests.get(url)
+baseURL = 'http://localhost:' + str(mysecrets.local_port) + '/sn/'
+url = baseURL + '?key=' + mysecrets.admin_key + '&start=' + str(last + 1)
+resp = requests.get(url, timeout=REQUEST_TIMEOUT)
 
 # validate response
 if resp.status_code != 200:
 	print('ERROR: server returned status code ' + str(resp.status_code))
 	quit(1)
 
-ids = resp.text.split()
-newlast = ids[-1]
-
 try:
-	int(newlast)
+	jobID = int(resp.text.strip())
 except ValueError:
-	print('ERROR: server did not return an integer value')
+	print('ERROR: server did not return a job ID')
+	quit(1)
+
+print('queued job ' + str(jobID))
+
+# wait for a worker to finish the job
+statusURL = baseURL + 'status/' + str(jobID) + '?key=' + mysecrets.admin_key
+deadline = time.monotonic() + TIMEOUT
+while True:
+	if time.monotonic() > deadline:
+		print('ERROR: job ' + str(jobID) + ' did not finish within '\
+		      + str(TIMEOUT) + ' seconds')
+		quit(1)
+
+	time.sleep(POLL_INTERVAL)
+	try:
+		resp = requests.get(statusURL, timeout=REQUEST_TIMEOUT)
+	except requests.RequestException as e:
+		# the server might just be restarting
+		print('WARNING: could not get job status: ' + str(e))
+		continue
+	if resp.status_code != 200:
+		print('ERROR: server returned status code ' + str(resp.status_code))
+		quit(1)
+
+	job = resp.json()
+	if job['status'] in ['done', 'failed']:
+		break
+
+if job['status'] == 'failed':
+	print('ERROR: job failed:\n' + str(job['error']))
 	quit(1)
 
-for i in ids:
-	print('got ' + str(i))
-	
+newlast = job['last_id']
+print('found ' + str(job['found']) + ' tournaments, up to ' + str(newlast))
+
 # record last tournament parsed
 f = open('lastID', 'w')
-f.write(newlast + '\n')
+f.write(str(newlast) + '\n')
 f.close()
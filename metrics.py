@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+
+# counters and timing histograms for the scrape/notify pipeline, so a slow run
+# can be blamed on the right stage. each process keeps its own and saves
+# snapshots of them (see qbnotify.publishMetrics), and /metrics adds them up
+# and shows them in Prometheus' text format
+
+import threading
+import time
+
+from contextlib import contextmanager
+
+# upper bounds of the histogram buckets, in seconds
+DEFAULT_BUCKETS = [0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+                   5.0, 10.0, 30.0]
+
+_metrics = {}
+_lock = threading.Lock()
+
+class Counter:
+	def __init__(self, name, help):
+		self.name = name
+		self.help = help
+		self.value = 0
+
+	def inc(self, amount=1):
+		with _lock:
+			self.value += amount
+
+	def snapshot(self):
+		return {'type': 'counter', 'help': self.help, 'value': self.value}
+
+class Histogram:
+	def __init__(self, name, help, buckets=DEFAULT_BUCKETS):
+		self.name = name
+		self.help = help
+		self.buckets = list(buckets)
+		self.counts = [0] * len(self.buckets)
+		self.sum = 0.0
+		self.count = 0
+
+	def observe(self, value):
+		with _lock:
+			for k, bound in enumerate(self.buckets):
+				if value <= bound:
+					self.counts[k] += 1
+					break
+			self.sum += value
+			self.count += 1
+
+	# times the body of a with statement
+	@contextmanager
+	def time(self):
+		start = time.perf_counter()
+		try:
+			yield
+		finally:
+			self.observe(time.perf_counter() - start)
+
+	def snapshot(self):
+		return {'type': 'histogram', 'help': self.help,
+		        'buckets': self.buckets, 'counts': list(self.counts),
+		        'sum': self.sum, 'count': self.count}
+
+def _register(cls, name, *args):
+	with _lock:
+		if name not in _metrics:
+			_metrics[name] = cls(name, *args)
+		return _metrics[name]
+
+def counter(name, help):
+	return _register(Counter, name, help)
+
+def histogram(name, help, buckets=DEFAULT_BUCKETS):
+	return _register(Histogram, name, help, buckets)
+
+# plain dict of every metric in this process (JSON-friendly)
+def snapshot():
+	with _lock:
+		return {name: m.snapshot() for name, m in _metrics.items()}
+
+# adds up snapshots from several processes
+def merge(snapshots):
+	total = {}
+	for snap in snapshots:
+		for name, m in snap.items():
+			if name not in total:
+				total[name] = dict(m, counts=list(m.get('counts', [])))
+			elif m['type'] == 'counter':
+				total[name]['value'] += m['value']
+			elif m['buckets'] == total[name]['buckets']:
+				t = total[name]
+				t['counts'] = [a + b for a, b in zip(t['counts'], m['counts'])]
+				t['sum'] += m['sum']
+				t['count'] += m['count']
+	return total
+
+def _fmt(value):
+	return repr(float(value)) if isinstance(value, float) else str(value)
+
+# Prometheus text exposition format
+def render(snap):
+	lines = []
+	for name in sorted(snap):
+		m = snap[name]
+		lines.append('# HELP ' + name + ' ' + m['help'])
+		lines.append('# TYPE ' + name + ' ' + m['type'])
+		if m['type'] == 'counter':
+			lines.append(name + ' ' + _fmt(m['value']))
+			continue
+
+		# prometheus buckets are cumulative
+		running = 0
+		for bound, count in zip(m['buckets'], m['counts']):
+			running += count
+			lines.append(name + '_bucket{le="' + _fmt(float(bound)) + '"} '
+			             + str(running))
+		lines.append(name + '_bucket{le="+Inf"} ' + str(m['count']))
+		lines.append(name + '_sum ' + _fmt(m['sum']))
+		lines.append(name + '_count ' + str(m['count']))
+	return '\n'.join(lines) + '\n'
+
+# one line per metric that moved between two snapshots of this process
+def summarize(before, after):
+	lines = []
+	for name in sorted(after):
+		m = after[name]
+		old = before.get(name)
+		if m['type'] == 'counter':
+			value = m['value'] - (old['value'] if old else 0)
+			if value:
+				lines.append(name + ': ' + _fmt(value))
+		else:
+			count = m['count'] - (old['count'] if old else 0)
+			total = m['sum'] - (old['sum'] if old else 0.0)
+			if count:
+				lines.append('%s: %d in %.3f s (%.1f ms avg)'
+				             % (name, count, total, 1000 * total / count))
+	return '\n'.join(lines)
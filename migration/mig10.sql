@@ -0,0 +1 @@
+ALTER TABLE scraped_id ADD attempts INTEGER NOT NULL DEFAULT 0;
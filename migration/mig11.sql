@@ -0,0 +1,3 @@
+DROP INDEX IF EXISTS ix_notification_state_type_diffs;
+DROP INDEX IF EXISTS ix_db_tournament_state_level_date;
+ANALYZE;
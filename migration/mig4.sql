@@ -0,0 +1,8 @@
+ALTER TABLE notification ADD diffs INTEGER NOT NULL DEFAULT 0;
+UPDATE notification SET diffs = (CASE WHEN diff_ms THEN 1 ELSE 0 END) | (CASE WHEN diff_hs THEN 2 ELSE 0 END) | (CASE WHEN diff_college THEN 4 ELSE 0 END) | (CASE WHEN diff_open THEN 8 ELSE 0 END) | (CASE WHEN diff_trash THEN 16 ELSE 0 END);
+ALTER TABLE notification DROP COLUMN diff_ms;
+ALTER TABLE notification DROP COLUMN diff_hs;
+ALTER TABLE notification DROP COLUMN diff_college;
+ALTER TABLE notification DROP COLUMN diff_open;
+ALTER TABLE notification DROP COLUMN diff_trash;
+CREATE INDEX ix_notification_type_state_diffs ON notification (type, state, diffs);
@@ -0,0 +1,6 @@
+PRAGMA journal_mode=WAL;
+DROP INDEX IF EXISTS ix_notification_type_state_diffs;
+CREATE INDEX ix_notification_state_type_diffs ON notification (state, type, diffs);
+CREATE INDEX ix_db_tournament_date ON db_tournament (date);
+CREATE INDEX ix_db_tournament_state_level_date ON db_tournament (state, level, date);
+ANALYZE;
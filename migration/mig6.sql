@@ -0,0 +1 @@
+ALTER TABLE scrape_job ADD kind VARCHAR(16) NOT NULL DEFAULT 'scrape';
@@ -0,0 +1 @@
+ALTER TABLE scrape_job ADD summary TEXT;
@@ -0,0 +1 @@
+ALTER TABLE scrape_job ADD profile BOOLEAN NOT NULL DEFAULT 0;
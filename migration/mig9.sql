@@ -0,0 +1,3 @@
+ALTER TABLE scrape_job ADD owner VARCHAR(255);
+ALTER TABLE scrape_job ADD lease_expires DATETIME;
+ALTER TABLE scrape_job ADD attempts INTEGER NOT NULL DEFAULT 0;
@@ -1,19 +1,30 @@
 #!/usr/bin/env python3
 
-import html
+import cProfile
+import gzip
+import hashlib
 import json
 import logging
-import math
 import os
+import queue
+import socket
 import sys
+import threading
+import time
+import traceback
 
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime, timedelta
 
 from flask import Flask, render_template, request, redirect, Response, \
-	send_from_directory, stream_with_context
+	send_from_directory, jsonify
 
 from flask_sqlalchemy import SQLAlchemy
 
+from sqlalchemy import event, or_, and_
+from sqlalchemy.ext.hybrid import hybrid_property
+
 from flask_security import Security, SQLAlchemyUserDatastore, \
     UserMixin, RoleMixin, login_required
 
@@ -21,9 +32,20 @@ from flask_login import current_user
 
 from flask_mail import Mail, Message
 
+# upcoming.json is also saved brotli-compressed if this is installed
+try:
+	import brotli
+except ImportError:
+	brotli = None
+
+import digest
+import metrics
 import scraper
 import mysecrets
+import spatial
+import throttle
 from constants import states
+from spatial import surfDist, EARTH_RADIUS
 
 # set up logging
 if '-dbg' in sys.argv[1:]:
@@ -37,11 +59,77 @@ else:
 # Create app
 app = Flask(__name__)
 app.config['DEBUG'] = ('-dbg' in sys.argv[1:])
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///qbnotify.db'
 
-# reload included file when it changes
-app.config['TEMPLATES_AUTO_RELOAD'] = True
+# profile every job this process runs (jobs can also ask for it themselves
+# with /sn/?profile=1). profiles are saved in PROFILE_DIR (relative to this
+# file, so workers and the web server agree on it wherever they're started)
+app.config['PROFILE_JOBS'] = ('-profile' in sys.argv[1:])
+app.config['PROFILE_DIR'] = 'logs'
+app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# (benchmarks point this somewhere else)
+app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('QBNOTIFY_DB',
+                                                       'sqlite:///qbnotify.db')
+
+# upcoming tournaments are rescanned for changes every so often, more often
+# the sooner they are: (days until the tournament, days between rescans),
+# first match wins. each rescan job checks at most RESCAN_LIMIT of them
+app.config['RESCAN_INTERVALS'] = [(7, 1), (30, 3), (None, 7)]
+app.config['RESCAN_LIMIT'] = 200
+
+# where workers publish the state of their HSQB rate limiters (one file each,
+# like METRICS_DIR), so the web server can show them (see throttle.py)
+app.config['THROTTLE_STATS_DIR'] = 'logs/throttle'
+
+# where every process (workers and web) saves its metrics, one file each,
+# which /metrics adds up. files of processes on other hosts are dropped once
+# they haven't been updated for METRICS_MAX_AGE seconds
+app.config['METRICS_DIR'] = 'logs/metrics'
+app.config['METRICS_MAX_AGE'] = 60 * 60
+
+# applied to every new DB connection. WAL lets the site keep reading while a
+# scrape holds a long write transaction
+app.config['SQLITE_PRAGMAS'] = [
+	'PRAGMA journal_mode=WAL',
+	'PRAGMA synchronous=NORMAL',  # safe with WAL, fsyncs only at checkpoints
+	'PRAGMA cache_size=-20000',   # 20 MB
+	'PRAGMA mmap_size=268435456', # 256 MB
+	'PRAGMA busy_timeout=5000',
+]
+
+# the map's tournament list. gzipped and brotli copies are saved next to it
+# (.gz and .br), along with its hash (.sha256), which serves as the ETag
+app.config['UPCOMING_FILE'] = 'static/upcoming.json'
+
+# /api/tournaments groups markers that would be within this many pixels of each
+# other, at zoom levels below MAP_CLUSTER_ZOOM
+app.config['MAP_CLUSTER_ZOOM'] = 8
+app.config['MAP_CLUSTER_PIXELS'] = 60
+
+# number of tournaments fetched from HSQB at once during a scrape
+app.config['SCRAPE_WORKERS'] = 8
+
+# a tournament HSQB keeps failing on (5xx, 429, connection errors) is tried
+# this many times, over as many runs, before it's counted as missing
+app.config['SCRAPE_MAX_ATTEMPTS'] = 5
+
+# big ID ranges can be split into shards of this many IDs (see /shard), which
+# any number of workers on any number of hosts (sharing the DB) claim for
+# SHARD_LEASE seconds at a time, renewing as they go. a shard whose lease runs
+# out is handed to another worker, up to SHARD_MAX_ATTEMPTS times
+app.config['SHARD_SIZE'] = 5000
+app.config['SHARD_LEASE'] = 600
+app.config['SHARD_MAX_ATTEMPTS'] = 3
+
+# jobs queued through /sn are leased the same way, so a job whose worker was
+# killed goes back to the queue instead of staying 'running' forever
+app.config['JOB_LEASE'] = 600
+app.config['JOB_MAX_ATTEMPTS'] = 3
+
+# set this to match circular notifications that many tournaments at a time
+# with the vectorized distance kernel (needs numpy, which isn't in
+# requirements.txt). off by default, since bench/pipeline.py finds it no
+# faster than the grid index; try it there first with your own numbers
+app.config['BATCH_MATCH_THRESHOLD'] = None
 
 # this shouldn't be tracked by git
 # just put secret_key = '<SOME RANDOM BYTES>' in the file mysecrets.py
@@ -78,6 +166,14 @@ app.config['MAIL_DEFAULT_SENDER'] = mysecrets.mail_sender
 app.config['SECURITY_EMAIL_SENDER'] = mysecrets.mail_sender
 mail = Mail(app)
 
+# outbox delivery: number of parallel SMTP connections, messages per second
+# across all of them (gmail gets unhappy if we go too fast), tries per message
+# within one delivery run, and delivery runs before a message is given up on
+app.config['MAIL_WORKERS'] = 4
+app.config['MAIL_RATE'] = 5
+app.config['MAIL_RETRIES'] = 3
+app.config['MAIL_MAX_ATTEMPTS'] = 5
+
 logging.debug('configured mail')
 
 ############################################################
@@ -111,17 +207,41 @@ security = Security(app, user_datastore)
 
 logging.debug('initialized security model')
 
+# bit in Notification.diffs for each tournament level
+diffBits = {'M': 1, 'H': 2, 'C': 4, 'O': 8, 'T': 16}
+
+# exposes one bit of Notification.diffs as a boolean attribute, which also
+# works in queries (e.g. Notification.query.filter(Notification.diff_hs))
+def _diffFlag(bit):
+	def fget(self):
+		return bool((self.diffs or 0) & bit)
+
+	def fset(self, value):
+		if value: self.diffs = (self.diffs or 0) | bit
+		else: self.diffs = (self.diffs or 0) & ~bit
+
+	def expr(cls):
+		return cls.diffs.op('&')(bit) != 0
+
+	return hybrid_property(fget, fset, expr=expr)
+
 # represents a single alert setting for the user
 class Notification(db.Model):
+	# no indexes besides the primary key: the site looks notifications up by
+	# email, and matching loads each type in one go, which an index on type
+	# only slows down (each type is about half the table; see bench/sqlite.py)
 	email = db.Column(db.String(255), primary_key=True)
 	id = db.Column(db.Integer(), primary_key=True)
 	type = db.Column(db.String(1))
-	diff_ms = db.Column(db.Boolean())
-	diff_hs = db.Column(db.Boolean())
-	diff_college = db.Column(db.Boolean())
-	diff_open = db.Column(db.Boolean())
-	diff_trash = db.Column(db.Boolean())
-	
+
+	# which levels the user wants, as a combination of diffBits
+	diffs = db.Column(db.Integer(), nullable=False, default=0)
+	diff_ms = _diffFlag(diffBits['M'])
+	diff_hs = _diffFlag(diffBits['H'])
+	diff_college = _diffFlag(diffBits['C'])
+	diff_open = _diffFlag(diffBits['O'])
+	diff_trash = _diffFlag(diffBits['T'])
+
 	lat = db.Column(db.Float(), nullable=True)
 	lon = db.Column(db.Float(), nullable=True)
 	radius = db.Column(db.Float(), nullable=True)
@@ -167,6 +287,12 @@ class Notification(db.Model):
 
 # DB listing for tournaments (SQL wrapper for Tournament class in scraper.py)
 class DBTournament(db.Model):
+	# upcoming.json, the map, the online listing, and rescans all only want
+	# tournaments that haven't happened yet
+	__table_args__ = (
+		db.Index('ix_db_tournament_date', 'date'),
+	)
+
 	id = db.Column(db.Integer(), primary_key=True)
 	name = db.Column(db.String(256))
 	date = db.Column(db.DateTime())
@@ -184,6 +310,29 @@ class DBTournament(db.Model):
 		self.lat = tourney.position[0]
 		self.lon = tourney.position[1]
 
+	# copies over anything that changed in a freshly scraped tournament
+	# returns whether anything did
+	def update(self, tourney):
+		new = (tourney.name, tourney.date, tourney.level, tourney.state,
+		       tourney.position[0], tourney.position[1])
+		if new == (self.name, self.date, self.level, self.state,
+		           self.lat, self.lon):
+			return False
+
+		self.name, self.date, self.level, self.state, self.lat, self.lon = new
+		return True
+
+	# inverse of the constructor
+	def toTournament(self):
+		tourney = scraper.Tournament()
+		tourney.id = self.id
+		tourney.name = self.name
+		tourney.date = self.date
+		tourney.level = self.level
+		tourney.state = self.state
+		tourney.position = (self.lat, self.lon)
+		return tourney
+
 	def dictify(self):
 		return {
 			'id': self.id,
@@ -196,27 +345,181 @@ class DBTournament(db.Model):
 		}
 
 	def genHTML(self, swap=False):
-		baseURL = 'http://hsquizbowl.org/db/tournaments/'
-		part1 = '<a href="' + baseURL + str(self.id) + '">'
-		part1 += html.escape(self.name) + '</a>'
-		part2 = self.date.isoformat().split('T')[0]
-		if not swap:
-			return part1 + ' on ' + part2
-		else:
-			return part2 + ': ' + part1
+		return digest.tournamentHTML(self.id, self.name, self.date, swap)
 	
+# every tournament ID a scrape has looked at, so an interrupted run can pick up
+# where it left off without fetching anything twice. found is false for IDs
+# that didn't give us a usable tournament, and null for IDs we couldn't fetch
+# (HSQB was down), which get fetched again next time. attempts counts those
+# failures, up to SCRAPE_MAX_ATTEMPTS
+class ScrapedID(db.Model):
+	id = db.Column(db.Integer(), primary_key=True)
+	found = db.Column(db.Boolean())
+	scraped = db.Column(db.DateTime())
+	attempts = db.Column(db.Integer(), nullable=False, default=0)
+
+# which tournaments each user has been emailed about, so a rerun never sends
+# the same tournament to someone twice
+class SentNotification(db.Model):
+	email = db.Column(db.String(255), primary_key=True)
+	tournament_id = db.Column(db.Integer(), primary_key=True)
+	sent = db.Column(db.DateTime())
+
+# what a tournament's page and GPX file looked like when we last rescanned
+# it (see scraper.rescanTournament), so unchanged pages can be skipped
+class PageState(db.Model):
+	id = db.Column(db.Integer(), primary_key=True)
+	page_etag = db.Column(db.String(255), nullable=True)
+	page_modified = db.Column(db.String(64), nullable=True)
+	gpx_etag = db.Column(db.String(255), nullable=True)
+	gpx_modified = db.Column(db.String(64), nullable=True)
+	hash = db.Column(db.String(64), nullable=True)
+	checked = db.Column(db.DateTime())
+
+	validatorNames = ['page_etag', 'page_modified', 'gpx_etag',
+	                  'gpx_modified', 'hash']
+
+	def validators(self):
+		return {name: getattr(self, name) for name in self.validatorNames}
+
+	def setValidators(self, validators):
+		for name in self.validatorNames:
+			setattr(self, name, validators.get(name))
+
+# bumped whenever the data behind something the web workers cache in memory
+# changes, so each of them knows to rebuild it (see cacheVersion)
+class CacheVersion(db.Model):
+	name = db.Column(db.String(64), primary_key=True)
+	version = db.Column(db.Integer(), nullable=False, default=0)
+
+# a request to run scrapeAndNotify (or rescanUpcoming, if kind is 'rescan'),
+# which worker.py picks up
+# status goes queued -> running -> done (or failed)
+class ScrapeJob(db.Model):
+	id = db.Column(db.Integer(), primary_key=True)
+	kind = db.Column(db.String(16), nullable=False, default='scrape')
+	start = db.Column(db.Integer())
+	end = db.Column(db.Integer())
+	workers = db.Column(db.Integer())
+	status = db.Column(db.String(16), default='queued')
+	created = db.Column(db.DateTime())
+	started = db.Column(db.DateTime(), nullable=True)
+	finished = db.Column(db.DateTime(), nullable=True)
+
+	# last ID the run reported (what getnew.py used to read from the stream),
+	# and how many tournaments it has found so far
+	last_id = db.Column(db.Integer(), nullable=True)
+	found = db.Column(db.Integer(), default=0)
+
+	error = db.Column(db.Text(), nullable=True)
+
+	# how long each stage took and what it did (see metrics.summarize)
+	summary = db.Column(db.Text(), nullable=True)
+
+	# run under the profiler (see profiled)
+	profile = db.Column(db.Boolean(), nullable=False, default=False)
+
+	# the worker running the job and until when (see claimJob). like a
+	# shard's, attempts goes up with every claim and doubles as a token
+	owner = db.Column(db.String(255), nullable=True)
+	lease_expires = db.Column(db.DateTime(), nullable=True)
+	attempts = db.Column(db.Integer(), nullable=False, default=0)
+
+	def dictify(self):
+		def fmt(d): return d.isoformat() if d else None
+		return {
+			'id': self.id,
+			'kind': self.kind,
+			'status': self.status,
+			'start': self.start,
+			'end': self.end,
+			'last_id': self.last_id,
+			'found': self.found,
+			'created': fmt(self.created),
+			'started': fmt(self.started),
+			'finished': fmt(self.finished),
+			'error': self.error,
+			'summary': self.summary,
+			'profile': self.profile
+		}
+
+# a piece of a sharded scrape job (kind 'sharded'), run with scrapeAndNotify
+# by whichever worker claims it. status goes pending -> running -> done (or
+# failed). attempts goes up with every claim, and doubles as a token: only the
+# worker holding the latest claim can update the shard
+class ScrapeShard(db.Model):
+	__table_args__ = (
+		db.Index('ix_scrape_shard_status_lease', 'status', 'lease_expires'),
+	)
+
+	id = db.Column(db.Integer(), primary_key=True)
+	job_id = db.Column(db.Integer(), index=True)
+	start = db.Column(db.Integer())
+	end = db.Column(db.Integer())
+	status = db.Column(db.String(16), default='pending')
+	owner = db.Column(db.String(128), nullable=True)
+	lease_expires = db.Column(db.DateTime(), nullable=True)
+	attempts = db.Column(db.Integer(), default=0)
+	last_id = db.Column(db.Integer(), nullable=True)
+	found = db.Column(db.Integer(), default=0)
+	finished = db.Column(db.DateTime(), nullable=True)
+	error = db.Column(db.Text(), nullable=True)
+
+	def dictify(self):
+		def fmt(d): return d.isoformat() if d else None
+		return {
+			'id': self.id,
+			'start': self.start,
+			'end': self.end,
+			'status': self.status,
+			'owner': self.owner,
+			'lease_expires': fmt(self.lease_expires),
+			'attempts': self.attempts,
+			'last_id': self.last_id,
+			'found': self.found,
+			'finished': fmt(self.finished),
+			'error': self.error
+		}
+
+# an email to a user, written by scrapeAndNotify and sent by deliverOutbox
+# status goes pending -> sent (or failed, after MAIL_MAX_ATTEMPTS runs)
+class OutboxMessage(db.Model):
+	__table_args__ = (
+		db.Index('ix_outbox_message_status_next', 'status', 'next_attempt'),
+	)
+
+	id = db.Column(db.Integer(), primary_key=True)
+	recipient = db.Column(db.String(255))
+	subject = db.Column(db.String(255))
+	html = db.Column(db.Text())
+	status = db.Column(db.String(16), default='pending')
+	attempts = db.Column(db.Integer(), default=0)
+	created = db.Column(db.DateTime())
+	next_attempt = db.Column(db.DateTime())
+	sent = db.Column(db.DateTime(), nullable=True)
+	error = db.Column(db.Text(), nullable=True)
+
 logging.info('started QBNotify')
 
+# tune every connection before it gets used
+def setSqlitePragmas(dbapiConn, connRecord):
+	cursor = dbapiConn.cursor()
+	for pragma in app.config['SQLITE_PRAGMAS']:
+		cursor.execute(pragma)
+	cursor.close()
+
 # @app.before_first_request
 # def create_user():
 with app.app_context():
+	event.listen(db.engine, 'connect', setSqlitePragmas)
 	db.create_all()
 	db.session.commit()
 
 # make necessary parameters available for login page
 @security.context_processor
 def security_context_processor():
-	return dict(clientkey=mysecrets.maps_client_api_key)
+	return dict(clientkey=mysecrets.maps_client_api_key,
+	            onlineListing=onlineListing())
 	
 # Views
 @app.route('/', methods=['GET', 'POST'])
@@ -228,6 +531,7 @@ def home():
 	                       states=states,
 	                       curNotes=noteList,
 	                       email=current_user.email,
+	                       onlineListing=onlineListing(),
 	                       clientkey=mysecrets.maps_client_api_key)
 
 # new coordinate notification added
@@ -331,129 +635,999 @@ def delNote():
 		
 	return redirect('/')
 
+# how long each stage of scrapeAndNotify takes (see metrics.py)
+storeTime = metrics.histogram('qbnotify_db_store_seconds',
+                              'Time to save and checkpoint a scraped tournament')
+matchTime = metrics.histogram('qbnotify_match_seconds',
+                              'Time to match a tournament (or a batch of '
+                              'them) against notifications')
+listingsTime = metrics.histogram('qbnotify_listings_seconds',
+                                 'Time to regenerate upcoming.json')
+renderTime = metrics.histogram('qbnotify_render_seconds',
+                               'Time to render an email')
+smtpTime = metrics.histogram('qbnotify_smtp_send_seconds',
+                             'Time to send an email over SMTP')
+tournamentsFound = metrics.counter('qbnotify_tournaments_found_total',
+                                   'Tournaments found by scrapes')
+emailsSent = metrics.counter('qbnotify_emails_sent_total', 'Emails sent')
+emailsFailed = metrics.counter('qbnotify_email_failures_total',
+                               'Failed attempts to send an email')
+
 # checks if the notification applies to difficulty of tournament
 def checkDifficulty(tournament, notification):
-	return (tournament.level == 'M' and notification.diff_ms) \
-		or (tournament.level == 'H' and notification.diff_hs) \
-		or (tournament.level == 'C' and notification.diff_college) \
-		or (tournament.level == 'O' and notification.diff_open) \
-		or (tournament.level == 'T' and notification.diff_trash)
+	return bool(notification.diffs & diffBits.get(tournament.level, 0))
+
+# maps (state, level) to the emails of everyone with a state notification
+# that covers it, so matching a tournament is a single lookup
+def indexStateNotes(notes):
+	index = {}
+	for note in notes:
+		for level, bit in diffBits.items():
+			if note.diffs & bit:
+				index.setdefault((note.state, level), []).append(note.email)
+	return index
+
+# adds the ID of every (tournament, circular notification) match to toSend,
+# using spatial.batchWithin. circles is a list of (notification, radius in
+# meters), where a notification is anything with email, lat, lon, and diffs.
+# gives the same matches as checking each pair with surfDist
+def matchCirclesBatch(tournaments, circles, today, toSend):
+	# coords are garbage for online tournaments, and past ones don't matter
+	tourneys = [t for t in tournaments
+	            if t.state != 'Online' and t.date > today]
+	if not tourneys or not circles:
+		return
 
-# get new tournaments and notify people
-# this will be called by snFrontend because it's a generator
-def scrapeAndNotify(start, end):
-	# get tournaments and setup email list
-	tournaments = []
-	today = datetime.today()
+	# row k of allowed says which notifications want levels[k]; the extra
+	# row at the end is for unknown levels, which nobody wants
+	levels = list(diffBits)
+	allowed = [[bool(note.diffs & diffBits[l]) for note, r in circles]
+	           for l in levels]
+	allowed.append([False] * len(circles))
+	pointClass = [levels.index(t.level) if t.level in levels else len(levels)
+	              for t in tourneys]
+
+	pairs = spatial.batchWithin(EARTH_RADIUS,
+	                            [t.position for t in tourneys],
+	                            [(note.lat, note.lon) for note, r in circles],
+	                            [r for note, r in circles],
+	                            pointClass, allowed)
+
+	for i, j in pairs:
+		email = circles[j][0].email
+		if email not in toSend: toSend[email] = set()
+		toSend[email].add(tourneys[i].id)
+
+# matches tournaments against every notification one at a time as they're
+# scraped, so a run never has to hold on to all of them. all that's kept is
+# toSend, which maps each email to the IDs of the tournaments it should get.
+# if BATCH_MATCH_THRESHOLD is set (and numpy is installed), circles are matched
+# that many tournaments at a time with matchCirclesBatch; otherwise (and for
+# the leftovers at the end) circles are bucketed by the part of the globe
+# they cover, so each tournament is only checked against circles that could
+# contain it
+class StreamMatcher:
+	def __init__(self, today):
+		self.today = today
+		self.toSend = {}
+
+		# area notifications, with radii converted to meters. only the
+		# columns matching needs are loaded, as plain rows rather than ORM
+		# objects, since scrapeAndNotify commits after every tournament and
+		# each commit would expire the objects (and reloading them costs a
+		# query apiece)
+		self.circles = [(note, spatial.toMeters(note.radius, note.unit))
+		                for note in Notification.query.filter_by(type='C')
+		                .with_entities(Notification.email, Notification.lat,
+		                               Notification.lon, Notification.diffs,
+		                               Notification.radius,
+		                               Notification.unit)]
+		self.circIndex = spatial.CircleIndex()
+		for note, radius_m in self.circles:
+			self.circIndex.add(note.lat, note.lon, radius_m, note)
+
+		# state notifications, indexed by what they ask for
+		self.stateIndex = indexStateNotes(
+			Notification.query.filter(Notification.type == 'S')
+			                  .filter(Notification.diffs != 0)
+			                  .with_entities(Notification.email,
+			                                 Notification.state,
+			                                 Notification.diffs).all())
+
+		self.blockSize = None
+		if spatial.np is not None:
+			self.blockSize = app.config['BATCH_MATCH_THRESHOLD']
+		self.pending = []
+
+	def _send(self, email, tourney):
+		if email not in self.toSend: self.toSend[email] = set()
+		self.toSend[email].add(tourney.id)
+
+	def add(self, tourney):
+		# nobody wants to hear about past tournaments
+		if tourney.date <= self.today:
+			return
+
+		# everyone who wants its state and difficulty
+		for email in self.stateIndex.get((tourney.state, tourney.level), []):
+			self._send(email, tourney)
+
+		# coords are garbage for online tournaments
+		if tourney.state == 'Online':
+			return
+
+		if self.blockSize:
+			self.pending.append(tourney)
+			if len(self.pending) >= self.blockSize:
+				matchCirclesBatch(self.pending, self.circles, self.today,
+				                  self.toSend)
+				self.pending = []
+		else:
+			self._matchCircles(tourney)
 
-	for tourney in scraper.getAllTournaments(start=start, end=end):
-		tournaments.append(tourney)
-		if tourney.date > today:
-			db.session.merge(DBTournament(tourney))
-		# client gets a list of tournament IDs
-		# we stream to prevent gunicorn from timing out
-		yield str(tourney.id) + '\n'
-	db.session.commit()
+	def _matchCircles(self, tourney):
+		for note, radius_m in self.circIndex.query(*tourney.position):
+			coord1 = (note.lat, note.lon)
+			coord2 = tourney.position
 
-	# update upcoming tournaments file
+			if checkDifficulty(tourney, note) \
+			   and surfDist(EARTH_RADIUS, coord1, coord2) < radius_m:
+				# correct difficulty and within range
+				self._send(note.email, tourney)
+
+	# returns toSend once every tournament has been added
+	def finish(self):
+		for tourney in self.pending:
+			self._matchCircles(tourney)
+		self.pending = []
+		return self.toSend
+
+# regenerates the map data and the list of online tournaments
+def updateListings(today):
+	# upcoming tournaments file
 	tmp = DBTournament.query.filter(DBTournament.date >= today)\
-	                        .filter(DBTournament.state != 'Online').all()
-	with open('static/upcoming.json', 'w') as outfile:
-		json.dump([t.dictify() for t in tmp], outfile)
+	                        .filter(DBTournament.state != 'Online')\
+	                        .order_by(DBTournament.id).all()
+	writeUpcoming(json.dumps([t.dictify() for t in tmp]).encode('utf-8'))
+
+	# web workers rebuild the map index and online listing from the DB
+	bumpCacheVersion('listings')
+
+# the current version of a cached thing (see CacheVersion)
+def cacheVersion(name):
+	row = db.session.get(CacheVersion, name)
+	return row.version if row else 0
+
+def bumpCacheVersion(name):
+	updated = CacheVersion.query.filter_by(name=name)\
+	                      .update({'version': CacheVersion.version + 1})
+	if not updated:
+		db.session.add(CacheVersion(name=name, version=1))
+	db.session.commit()
+
+# HTML listing of upcoming online tournaments for the home page, by level.
+# kept in memory by each web worker and rebuilt when a scrape or rescan
+# changes the listings, and once a day so past tournaments drop off
+_onlineListing = (None, None)
+
+def onlineListing():
+	global _onlineListing
+	today = datetime.today().replace(hour=0, minute=0, second=0,
+	                                 microsecond=0)
+	version = (cacheVersion('listings'), today)
+	if _onlineListing[0] == version:
+		return _onlineListing[1]
+
+	byLevel = {}
+	for t in DBTournament.query.filter(DBTournament.date >= today)\
+	                           .filter(DBTournament.state == 'Online')\
+	                           .order_by(DBTournament.level, DBTournament.date):
+		byLevel.setdefault(t.level, []).append(t)
 
-	# now for online ones
-	allOnline = DBTournament.query.filter(DBTournament.date >= today)\
-	                              .filter(DBTournament.state == 'Online')
 	fullDiffs = ['Middle School', 'High School', 'College', 'Open', 'Trash']
-	with open('templates/upcoming_online_include.html', 'w') as outfile:
-		for diff in fullDiffs:
-			tmp = allOnline.filter(DBTournament.level == diff[0])\
-			               .order_by(DBTournament.date).all()
-			outfile.write('<h3>' + diff + '</h3>\n')
-			if not tmp:
-				outfile.write('None at this time\n')
-			outfile.write('<br />\n'.join([t.genHTML(True) for t in tmp]))
-			outfile.write('<br />\n')
-	toSend = {}
+	html = ''
+	for diff in fullDiffs:
+		tmp = byLevel.get(diff[0], [])
+		html += '<h3>' + diff + '</h3>\n'
+		if not tmp:
+			html += 'None at this time\n'
+		html += '<br />\n'.join([t.genHTML(True) for t in tmp])
+		html += '<br />\n'
+
+	_onlineListing = (version, html)
+	return html
+
+# replaces a file without anyone ever being able to read half of it
+def writeAtomic(path, data):
+	tmpPath = path + '.' + str(os.getpid()) + '.tmp'
+	with open(tmpPath, 'wb') as outfile:
+		outfile.write(data)
+	os.replace(tmpPath, path)
+
+# saves upcoming.json and its compressed copies, unless it hasn't changed
+def writeUpcoming(data):
+	path = app.config['UPCOMING_FILE']
+	sha = hashlib.sha256(data).hexdigest()
+	try:
+		with open(path + '.sha256') as infile:
+			if infile.read().strip() == sha and os.path.exists(path):
+				logging.debug('upcoming tournaments unchanged')
+				return
+	except FileNotFoundError:
+		pass
+
+	writeAtomic(path, data)
+	writeAtomic(path + '.gz', gzip.compress(data, 9, mtime=0))
+	if brotli:
+		writeAtomic(path + '.br', brotli.compress(data))
+	elif os.path.exists(path + '.br'):
+		os.remove(path + '.br')
+
+	# the hash goes last, so it never names a file that isn't there yet
+	writeAtomic(path + '.sha256', (sha + '\n').encode('ascii'))
+
+# upcoming (non-online) tournaments for /api/tournaments, kept in memory by
+# each web worker. rebuilt like onlineListing
+_mapIndex = (None, None)
+
+def mapIndex():
+	global _mapIndex
+	today = datetime.today().replace(hour=0, minute=0, second=0,
+	                                 microsecond=0)
+	version = (cacheVersion('listings'), today)
+
+	if _mapIndex[0] != version:
+		index = spatial.PointIndex()
+		for t in DBTournament.query.filter(DBTournament.date >= today)\
+		                           .filter(DBTournament.state != 'Online'):
+			if t.lat is not None and t.lon is not None:
+				index.add(t.lat, t.lon, t.dictify())
+		_mapIndex = (version, index)
+		logging.debug('rebuilt map index with ' + str(index.size)\
+		              + ' tournaments')
+
+	return _mapIndex[1]
+
+# get new tournaments and notify people
+# this is a generator so runJob can record progress (it yields tournament IDs)
+# when resuming, the last ID an earlier run found comes first, as
+# '<id> resumed', so it isn't counted as found again (see parseProgress)
+def scrapeAndNotify(start, end, workers=1):
+	# tournaments are matched as they come in, so no notification work waits
+	# on the whole range being fetched
+	today = datetime.today()
+	matcher = StreamMatcher(today)
+	foundAny = False
+
+	# IDs an earlier (interrupted) run already got through don't need to be
+	# fetched again. the upcoming ones it found are in the DB, and still need
+	# to be matched, since emails only go out at the end of a run
+	done = ScrapedID.query.filter(ScrapedID.id >= start)\
+	                      .filter(ScrapedID.id <= end).all()
+	doneIDs = set(d.id for d in done if d.found is not None)
+	foundIDs = sorted(d.id for d in done if d.found)
+	attempts = {d.id: d.attempts or 0 for d in done if d.found is None}
+	if foundIDs:
+		logging.info('resuming; ' + str(len(doneIDs))\
+		             + ' IDs already scraped')
+
+	# an ID we couldn't fetch is tried again next time, until it has failed
+	# SCRAPE_MAX_ATTEMPTS times
+	def checkpointFailed(tid, now):
+		tries = attempts.get(tid, 0) + 1
+		found = None
+		if tries >= app.config['SCRAPE_MAX_ATTEMPTS']:
+			logging.warning('giving up on tournament ' + str(tid)\
+			                + ' after ' + str(tries) + ' attempts')
+			found = False
+		db.session.merge(ScrapedID(id=tid, found=found, attempts=tries,
+		                           scraped=now))
+
+	for t in DBTournament.query.filter(DBTournament.id >= start)\
+	                           .filter(DBTournament.id <= end)\
+	                           .filter(DBTournament.date > today):
+		if t.id in doneIDs:
+			matcher.add(t.toTournament())
+
+	if foundIDs:
+		foundAny = True
+		yield str(foundIDs[-1]) + ' resumed\n'
+
+	prevID = start - 1
+	failed = set()
+	for tourney in scraper.getAllTournaments(start=start, end=end,
+	                                         workers=workers, skip=doneIDs,
+	                                         failed=failed):
+		tournamentsFound.inc()
+		with matchTime.time():
+			matcher.add(tourney)
+
+		with storeTime.time():
+			if tourney.date > today:
+				db.session.merge(DBTournament(tourney))
+
+			# checkpoint: everything we skipped over on the way here was
+			# missing, or couldn't be fetched
+			now = datetime.now()
+			for tid in range(prevID + 1, tourney.id):
+				if tid in failed:
+					checkpointFailed(tid, now)
+				elif tid not in doneIDs:
+					db.session.merge(ScrapedID(id=tid, found=False,
+					                           scraped=now))
+			db.session.merge(ScrapedID(id=tourney.id, found=True,
+			                           scraped=now))
+			db.session.commit()
+		prevID = tourney.id
+
+		# report progress
+		foundAny = True
+		yield str(tourney.id) + '\n'
+
+	# errors past the last tournament found weren't checkpointed above, but
+	# finishShardedJob needs to know about them
+	if failed:
+		logging.warning('could not fetch ' + str(len(failed))\
+		                + ' tournaments')
+		now = datetime.now()
+		for tid in failed:
+			if tid > prevID:
+				checkpointFailed(tid, now)
+		db.session.commit()
+
+	with listingsTime.time():
+		updateListings(today)
+
+	with matchTime.time():
+		toSend = matcher.finish()
 
 	# if no new tournaments are present, return start-1
-	if not tournaments:
+	if not foundAny:
 		yield str(start-1)
 		return
-	
-	# get area notifications
-	circNotes = Notification.query.filter_by(type='C').all()
-	
-	# The area checking has bad complexity, but it's a cheap operation done
-	# relatively few times and I'm not going to implement a complicated
-	# spatial partitioning scheme to save time in the unlikely case that
-	# thousands of tournaments are announced in a day. If that happens, the
-	# state of quizbowl will be so amazing that I won't mind rewriting it.
-	
-	for tourney in tournaments:
-		# handle state notification first
-		stateNotes = Notification.query.filter_by(state=tourney.state).all()
-		for note in stateNotes:
-			if checkDifficulty(tourney, note) and tourney.date > today:
-				# correct difficulty and in the future; add tournament
-				if note.email not in toSend: toSend[note.email] = set()
-				toSend[note.email].add(tourney)
-
-		# handle area notifications
-		for note in circNotes:
-			# coords are garbage for online tournaments
-			if tourney.state == 'Online': continue
-			
-			coord1 = (note.lat, note.lon)
-			coord2 = tourney.position
-
-			# must use meters for radius
-			if note.unit == 'mi': radius_m = note.radius * 1609.3
-			elif note.unit == 'ft': radius_m = note.radius * 0.3048
-			elif note.unit == 'km': radius_m = note.radius * 1000.0
-			else: radius_m = note.radius
 
-			if checkDifficulty(tourney, note) and tourney.date > today \
-			   and surfDist(6371008.8, coord1, coord2) < radius_m:
-				# correct difficlty, in the future, and within range
-				if note.email not in toSend: toSend[note.email] = set()
-				toSend[note.email].add(tourney)
+	# don't tell anyone about the same tournament twice (if this run is
+	# resuming, some of these might have been sent already)
+	sent = set((sn.email, sn.tournament_id) for sn in SentNotification.query\
+	           .filter(SentNotification.tournament_id >= start)\
+	           .filter(SentNotification.tournament_id <= end))
+	if sent:
+		for email in toSend:
+			toSend[email] = set(tid for tid in toSend[email]
+			                    if (email, tid) not in sent)
+
+	# everything matched is upcoming, so it's in the DB. we only load the
+	# tournaments someone is getting, a chunk at a time
+	wanted = sorted(set().union(*toSend.values()))
+	tourneys = {}
+	for k in range(0, len(wanted), 500):
+		for t in DBTournament.query.filter(
+		             DBTournament.id.in_(wanted[k:k + 500])):
+			tourneys[t.id] = t
 
 	# time to actually send the emails
+	# they go in the outbox first, so nothing is lost if sending fails. the
+	# sent log is written in the same transaction
 	subj = 'You have new quizbowl tournament notifications'
-	# optimize for batch sending
-	with app.app_context(), mail.connect() as conn:
-		for email in toSend:
-			content = 'The following tournaments have recently been '\
-			          'posted to the hsquizbowl.org database:<br />'
-			for tourney in toSend[email]:
-				content += '<br />' + DBTournament(tourney).genHTML()
-
-			content += '<br /><br />'
-			content += 'You can edit your notification settings '
-			content += 'or view a map of all upcoming tournaments at '
-			content += '<a href="https://qbnotify.msmitchell.org">'
-			content += 'qbnotify.msmitchell.org'
-			content += '</a>.'
-			
-			msg = Message(recipients=[email],
-			              html=content,
-			              subject=subj)
-			conn.send(msg)
-			logging.info('notified user ' + email)
-
-# authenticate and call scrapeAndNotify
+	now = datetime.now()
+	renderer = digest.DigestRenderer()
+	for email in toSend:
+		if not toSend[email]: continue
+
+		with renderTime.time():
+			content = renderer.render([tourneys[tid] for tid in toSend[email]
+			                           if tid in tourneys])
+		db.session.add(OutboxMessage(recipient=email, subject=subj,
+		                             html=content, status='pending',
+		                             attempts=0, created=now,
+		                             next_attempt=now))
+		for tid in toSend[email]:
+			db.session.add(SentNotification(email=email,
+			                                tournament_id=tid,
+			                                sent=now))
+	db.session.commit()
+
+	deliverOutbox()
+
+# spaces out sends so all connections together stay under rate per second
+class _SendLimiter:
+	def __init__(self, rate):
+		self.interval = 1.0 / rate if rate else 0
+		self.lock = threading.Lock()
+		self.next = time.monotonic()
+
+	def wait(self):
+		with self.lock:
+			now = time.monotonic()
+			slot = max(now, self.next)
+			self.next = slot + self.interval
+		time.sleep(max(0, slot - now))
+
+# sends a share of the outbox over one SMTP connection (runs in its own thread)
+# puts (message ID, error or None) on results for each message, then None
+def _sendChunk(chunk, limiter, results):
+	conn = None
+	with app.app_context():
+		try:
+			for msgID, recipient, subject, content in chunk:
+				error = None
+				for attempt in range(app.config['MAIL_RETRIES']):
+					try:
+						if conn is None:
+							conn = mail.connect()
+							conn.__enter__()
+
+						limiter.wait()
+						with smtpTime.time():
+							conn.send(Message(recipients=[recipient],
+							                  html=content,
+							                  subject=subject))
+						emailsSent.inc()
+						error = None
+						break
+					except Exception as e:
+						emailsFailed.inc()
+						# start over with a fresh connection
+						error = repr(e)
+						logging.warning('could not email ' + recipient\
+						                + ': ' + error)
+						if conn is not None:
+							try: conn.__exit__(None, None, None)
+							except Exception: pass
+							conn = None
+						# no point waiting if we're giving up anyway
+						if attempt + 1 < app.config['MAIL_RETRIES']:
+							time.sleep(2**attempt)
+
+				results.put((msgID, error))
+		finally:
+			if conn is not None:
+				try: conn.__exit__(None, None, None)
+				except Exception: pass
+			results.put(None)
+
+# sends every pending outbox message that's due, over MAIL_WORKERS parallel
+# connections. each message is marked as sent as soon as it goes out, so
+# running this again won't resend it
+# returns the number of messages sent
+def deliverOutbox():
+	now = datetime.now()
+	due = OutboxMessage.query.filter_by(status='pending')\
+	                         .filter(OutboxMessage.next_attempt <= now)\
+	                         .order_by(OutboxMessage.id).all()
+
+	# claim them, in case another worker is delivering too. if we die
+	# partway through, the rest become due again once the claim runs out
+	todo = []
+	for m in due:
+		claimed = OutboxMessage.query\
+			.filter_by(id=m.id, status='pending')\
+			.filter(OutboxMessage.next_attempt <= now)\
+			.update({'next_attempt': now + timedelta(minutes=15)})
+		if claimed:
+			# threads get plain values, only this thread touches the DB
+			todo.append((m.id, m.recipient, m.subject, m.html))
+	db.session.commit()
+
+	if not todo:
+		return 0
+
+	nThreads = min(app.config['MAIL_WORKERS'], len(todo))
+	limiter = _SendLimiter(app.config['MAIL_RATE'])
+	results = queue.Queue()
+	for k in range(nThreads):
+		threading.Thread(target=_sendChunk,
+		                 args=(todo[k::nThreads], limiter, results)).start()
+
+	sent = 0
+	running = nThreads
+	while running:
+		item = results.get()
+		if item is None:
+			running -= 1
+			continue
+
+		msgID, error = item
+		msg = db.session.get(OutboxMessage, msgID)
+		if error is None:
+			if msg.status == 'pending':
+				msg.status = 'sent'
+				msg.sent = datetime.now()
+				sent += 1
+				logging.info('notified user ' + msg.recipient)
+		else:
+			# back off before trying again in a later run
+			msg.attempts += 1
+			msg.error = error
+			msg.next_attempt = datetime.now()\
+			                   + timedelta(minutes=2**msg.attempts)
+			if msg.attempts >= app.config['MAIL_MAX_ATTEMPTS']:
+				msg.status = 'failed'
+				logging.error('giving up on emailing ' + msg.recipient)
+		db.session.commit()
+
+	return sent
+
+# how long to wait between rescans of a tournament that's ahead days away
+def rescanInterval(ahead):
+	for limit, interval in app.config['RESCAN_INTERVALS']:
+		if limit is None or ahead.days < limit:
+			return timedelta(days=interval)
+
+def _rescanSafely(tid, validators):
+	try:
+		return scraper.rescanTournament(tid, validators)
+	except Exception:
+		logging.exception('rescan failed on tournament ' + str(tid))
+		return (None, validators)
+
+# rechecks the upcoming tournaments that are due for it (soonest first), and
+# updates the ones that changed. pages that haven't changed since the last
+# rescan are skipped without parsing. yields the IDs of changed tournaments
+def rescanUpcoming(limit, workers=1):
+	now = datetime.now()
+	rows = db.session.query(DBTournament, PageState)\
+	                 .outerjoin(PageState, PageState.id == DBTournament.id)\
+	                 .filter(DBTournament.date >= now)\
+	                 .order_by(DBTournament.date)
+
+	due = []
+	for t, state in rows:
+		if state is None or state.checked + rescanInterval(t.date - now) <= now:
+			due.append((t, state))
+			if len(due) >= limit: break
+
+	logging.info('rescanning ' + str(len(due)) + ' upcoming tournaments')
+
+	# the threads only get plain values. committing below expires the ORM
+	# objects, and reloading them needs the app context, which threads lack
+	args = [(t.id, state.validators() if state else None)
+	        for t, state in due]
+
+	changed = False
+	with ThreadPoolExecutor(max_workers=max(workers, 1)) as pool:
+		results = pool.map(lambda a: _rescanSafely(*a), args)
+		for (t, state), (tourney, validators) in zip(due, results):
+			if state is None:
+				state = PageState(id=t.id)
+				db.session.add(state)
+			if validators:
+				state.setValidators(validators)
+			state.checked = datetime.now()
+
+			if tourney and t.update(tourney):
+				logging.info('tournament ' + str(t.id) + ' changed')
+				changed = True
+				yield str(t.id) + '\n'
+
+			db.session.commit()
+
+	if changed:
+		updateListings(datetime.today())
+
+# takes the oldest queued job and marks it as running
+# returns None if there's nothing to do (or another worker got there first)
+# a running job whose lease has run out lost its worker, and is taken over
+def claimJob():
+	now = datetime.now()
+	lease = timedelta(seconds=app.config['JOB_LEASE'])
+	claimable = or_(ScrapeJob.status == 'queued',
+	                and_(ScrapeJob.status == 'running',
+	                     ScrapeJob.lease_expires < now))
+	candidates = [(j.id, j.attempts) for j in ScrapeJob.query
+	              .filter(claimable).order_by(ScrapeJob.id).limit(10)]
+
+	for jobID, attempts in candidates:
+		# (see claimShard)
+		if attempts >= app.config['JOB_MAX_ATTEMPTS']:
+			if _updateJob(jobID, attempts, claimable, status='failed',
+			              finished=now, error='lease expired '\
+			                                  + str(attempts) + ' times'):
+				logging.error('giving up on scrape job ' + str(jobID))
+			continue
+
+		# what the last attempt found still counts; scrapeAndNotify doesn't
+		# report it as found again when it resumes
+		if _updateJob(jobID, attempts, claimable, status='running',
+		              owner=workerName, started=now, lease_expires=now + lease,
+		              attempts=attempts + 1):
+			if attempts:
+				logging.warning('taking over scrape job ' + str(jobID))
+			return db.session.get(ScrapeJob, jobID)
+
+	return None
+
+# splits the HSQB rate limits evenly between the jobs and shards running right
+# now (on any host), so adding workers doesn't add load on HSQB. workers
+# call this when they start something and with every heartbeat
+def shareLimits():
+	now = datetime.now()
+	running = ScrapeJob.query.filter_by(status='running')\
+	                         .filter(ScrapeJob.lease_expires > now).count()\
+	        + ScrapeShard.query.filter_by(status='running')\
+	                           .filter(ScrapeShard.lease_expires > now).count()
+	throttle.setShare(1.0 / max(1, running))
+
+# (see _updateShard)
+def _updateJob(jobID, token, *conditions, **values):
+	updated = ScrapeJob.query\
+		.filter_by(id=jobID, attempts=token).filter(*conditions)\
+		.update(values, synchronize_session=False)
+	db.session.commit()
+	return bool(updated)
+
+# raised when another worker has taken over a job or shard we were running
+class LeaseLost(Exception):
+	pass
+
+# calls renew every interval seconds from another thread while the body of
+# the with statement runs, so a lease stays fresh even when nothing is being
+# reported (long stretches of missing IDs, sending emails). renew returns
+# whether the lease is still ours; the event this yields is set once it isn't
+@contextmanager
+def heartbeat(renew, interval):
+	lost = threading.Event()
+	stop = threading.Event()
+
+	def beat():
+		while not stop.wait(interval):
+			# its own app context, so it gets its own DB session
+			try:
+				with app.app_context():
+					if not renew():
+						lost.set()
+						return
+			except Exception:
+				# maybe the DB was busy; the next beat will try again
+				logging.exception('could not renew lease')
+
+	thread = threading.Thread(target=beat, daemon=True)
+	thread.start()
+	try:
+		yield lost
+	finally:
+		stop.set()
+		thread.join()
+
+# identifies this worker in ScrapeShard.owner
+workerName = socket.gethostname() + ':' + str(os.getpid())
+
+# saves this process's rate limiter state for /stats/throttle (if it has
+# talked to a limited host at all), and its metrics for /metrics
+def publishStats():
+	stats = throttle.stats()
+	if stats:
+		stats['updated'] = datetime.now().isoformat()
+		writeAtomic(processFile(app.config['THROTTLE_STATS_DIR']),
+		            json.dumps(stats).encode('utf-8'))
+
+	publishMetrics(metrics.snapshot())
+
+# this process's file in directory, <host>-<pid>.json. the name is worked out
+# every time, since gunicorn can fork web processes after this module is
+# imported
+def processFile(directory):
+	os.makedirs(directory, exist_ok=True)
+	name = socket.gethostname() + '-' + str(os.getpid()) + '.json'
+	return os.path.join(directory, name)
+
+# saves a snapshot of this process's metrics in METRICS_DIR
+def publishMetrics(snap):
+	writeAtomic(processFile(app.config['METRICS_DIR']),
+	            json.dumps(snap).encode('utf-8'))
+
+# web processes count things too (geocoding for /addCoord), so they save their
+# metrics after any request that changed them
+_lastPublished = [None]
+
+@app.after_request
+def publishWebMetrics(response):
+	publishChangedMetrics()
+	return response
+
+def publishChangedMetrics():
+	snap = metrics.snapshot()
+	if snap != _lastPublished[0]:
+		try:
+			publishMetrics(snap)
+			_lastPublished[0] = snap
+		except OSError as e:
+			logging.warning('could not save metrics: ' + str(e))
+
+# whether a file saved by processFile belongs to a process that's gone:
+# processes on this host are looked up, and others are given METRICS_MAX_AGE
+# seconds
+def staleProcessFile(path):
+	host, _, pid = os.path.basename(path)[:-len('.json')].rpartition('-')
+	if host == socket.gethostname():
+		try:
+			os.kill(int(pid), 0)
+		except ProcessLookupError:
+			return True
+		except (ValueError, PermissionError):
+			# not a pid, or someone else's process
+			pass
+		return False
+	return time.time() - os.path.getmtime(path) > app.config['METRICS_MAX_AGE']
+
+# where profiles are saved, listed, and downloaded from
+def profileDir():
+	return os.path.join(app.root_path, app.config['PROFILE_DIR'])
+
+# runs the body of a with statement under cProfile if enabled is set, and
+# saves the result as PROFILE_DIR/profile-<time>-<name>.prof
+@contextmanager
+def profiled(enabled, name):
+	if not enabled:
+		yield
+		return
+
+	prof = cProfile.Profile()
+	prof.enable()
+	try:
+		yield
+	finally:
+		prof.disable()
+		os.makedirs(profileDir(), exist_ok=True)
+		path = os.path.join(profileDir(), 'profile-'\
+		                    + datetime.now().strftime('%Y%m%d-%H%M%S') + '-'\
+		                    + name + '.prof')
+		prof.dump_stats(path)
+		logging.info('saved profile to ' + path)
+
+# reads a line from scrapeAndNotify (or rescanUpcoming) as (ID, whether it's
+# a tournament this run found). scrapeAndNotify reports start-1 when nothing
+# was found, and what an earlier run found as '<id> resumed'
+def parseProgress(line, start):
+	parts = line.split()
+	tid = int(parts[0])
+	return (tid, tid >= start and parts[1:] != ['resumed'])
+
+# runs a claimed job to completion, recording progress as it goes
+# everything is written through _updateJob, so a worker that lost its lease
+# can't overwrite what the one that took over records
+def runJob(job):
+	logging.info('running scrape job ' + str(job.id))
+	lease = timedelta(seconds=app.config['JOB_LEASE'])
+	jobID, token, kind, start = job.id, job.attempts, job.kind, job.start
+	found = job.found or 0
+	lastID = job.last_id
+	status = error = None
+	published = time.monotonic()
+	before = metrics.snapshot()
+
+	def renew():
+		shareLimits()
+		return _updateJob(jobID, token,
+		                  lease_expires=datetime.now() + lease)
+
+	# cProfile only sees the thread it's started in, so profiled runs fetch
+	# (and parse) one tournament at a time
+	profile = job.profile or app.config['PROFILE_JOBS']
+	workers = 1 if profile else job.workers
+	shareLimits()
+
+	with profiled(profile, 'job' + str(jobID)):
+		try:
+			with heartbeat(renew, lease.total_seconds() / 4) as lost:
+				if kind == 'rescan':
+					lines = rescanUpcoming(app.config['RESCAN_LIMIT'],
+					                       workers)
+				else:
+					lines = scrapeAndNotify(start, job.end, workers)
+
+				for line in lines:
+					tid, new = parseProgress(line, start)
+					if new:
+						found += 1
+					lastID = max(tid, lastID or tid)
+					if lost.is_set() or not _updateJob(
+					    jobID, token, found=found, last_id=lastID,
+					    lease_expires=datetime.now() + lease):
+						raise LeaseLost()
+
+					if time.monotonic() - published > 5:
+						publishStats()
+						published = time.monotonic()
+
+				if lost.is_set():
+					raise LeaseLost()
+		except LeaseLost:
+			db.session.rollback()
+			logging.warning('lost lease on scrape job ' + str(jobID))
+		except Exception:
+			db.session.rollback()
+			status = 'failed'
+			error = traceback.format_exc()
+			logging.exception('scrape job ' + str(jobID) + ' failed')
+		else:
+			if kind != 'rescan':
+				lastID = capLastID(start, lastID)
+			status = 'done'
+
+	summary = metrics.summarize(before, metrics.snapshot())
+	if status and _updateJob(jobID, token, status=status, error=error,
+	                         last_id=lastID, finished=datetime.now(),
+	                         summary=summary):
+		logging.info('scrape job ' + str(jobID) + ' ' + status)
+	elif status:
+		logging.warning('lost lease on scrape job ' + str(jobID)\
+		                + ' before it could be marked ' + status)
+
+	publishStats()
+	logSummary('scrape job ' + str(jobID), summary)
+
+# logs a run's metrics summary, and where the rate limits ended up
+def logSummary(what, summary):
+	for line in summary.splitlines():
+		logging.info(what + ': ' + line)
+	for host, stats in throttle.stats().items():
+		logging.info('rate limit for ' + host + ': ' + json.dumps(stats))
+
+# claims the first shard that's pending or whose lease has run out
+# returns None if there's nothing to do
+def claimShard():
+	now = datetime.now()
+	lease = timedelta(seconds=app.config['SHARD_LEASE'])
+	claimable = or_(ScrapeShard.status == 'pending',
+	                and_(ScrapeShard.status == 'running',
+	                     ScrapeShard.lease_expires < now))
+	candidates = [(s.id, s.job_id, s.attempts) for s in ScrapeShard.query
+	              .filter(claimable).order_by(ScrapeShard.id).limit(10)]
+
+	for shardID, jobID, attempts in candidates:
+		# a shard that keeps killing its workers isn't going to get better
+		if attempts >= app.config['SHARD_MAX_ATTEMPTS']:
+			if _updateShard(shardID, attempts, claimable, status='failed',
+			                finished=now, error='lease expired '\
+			                                    + str(attempts) + ' times'):
+				logging.error('giving up on shard ' + str(shardID))
+				finishShardedJob(jobID)
+			continue
+
+		if _updateShard(shardID, attempts, claimable, status='running',
+		                owner=workerName, lease_expires=now + lease,
+		                attempts=attempts + 1):
+			return db.session.get(ScrapeShard, shardID)
+
+	return None
+
+# updates a shard if nobody has claimed it since the claim numbered token
+# (and it matches any extra conditions). returns whether it did
+def _updateShard(shardID, token, *conditions, **values):
+	updated = ScrapeShard.query\
+		.filter_by(id=shardID, attempts=token).filter(*conditions)\
+		.update(values, synchronize_session=False)
+	db.session.commit()
+	return bool(updated)
+
+# runs a claimed shard, renewing its lease with every tournament found and
+# from a heartbeat in between
+def runShard(shard):
+	logging.info('running shard ' + str(shard.id) + ' (' + str(shard.start)\
+	             + '-' + str(shard.end) + ') of job ' + str(shard.job_id))
+	lease = timedelta(seconds=app.config['SHARD_LEASE'])
+	job = db.session.get(ScrapeJob, shard.job_id)
+	shardID, jobID, token = shard.id, shard.job_id, shard.attempts
+	found = shard.found or 0
+	lastID = shard.last_id
+	before = metrics.snapshot()
+
+	def renew():
+		shareLimits()
+		return _updateShard(shardID, token,
+		                    lease_expires=datetime.now() + lease)
+
+	# (see runJob)
+	profile = job.profile or app.config['PROFILE_JOBS']
+	workers = 1 if profile else job.workers
+	shareLimits()
+
+	with profiled(profile, 'shard' + str(shardID)):
+		try:
+			with heartbeat(renew, lease.total_seconds() / 4) as lost:
+				for line in scrapeAndNotify(shard.start, shard.end, workers):
+					tid, new = parseProgress(line, shard.start)
+					if new:
+						found += 1
+					lastID = max(tid, lastID or tid)
+
+					if lost.is_set() or not _updateShard(
+					    shardID, token, found=found, last_id=lastID,
+					    lease_expires=datetime.now() + lease):
+						raise LeaseLost()
+
+				if lost.is_set():
+					raise LeaseLost()
+		except LeaseLost:
+			db.session.rollback()
+			logging.warning('lost lease on shard ' + str(shardID))
+		except Exception:
+			db.session.rollback()
+			logging.exception('shard ' + str(shardID) + ' failed')
+
+			# another worker gets a try, unless this was the last one
+			if token < app.config['SHARD_MAX_ATTEMPTS']:
+				_updateShard(shardID, token, status='pending', owner=None,
+				             lease_expires=None,
+				             error=traceback.format_exc())
+			else:
+				_updateShard(shardID, token, status='failed',
+				             finished=datetime.now(),
+				             error=traceback.format_exc())
+				finishShardedJob(jobID)
+		else:
+			# the lease could still have run out between the last beat and
+			# here, in which case the shard is someone else's now
+			if _updateShard(shardID, token, status='done',
+			                finished=datetime.now()):
+				logging.info('shard ' + str(shardID) + ' finished')
+				finishShardedJob(jobID)
+			else:
+				logging.warning('lost lease on shard ' + str(shardID)\
+				                + ' before it could be marked done')
+
+	publishStats()
+	logSummary('shard ' + str(shardID),
+	           metrics.summarize(before, metrics.snapshot()))
+
+# the last ID getnew.py can safely start after: just before the first ID
+# in [start, lastID] we couldn't fetch, so the next run tries it again
+def capLastID(start, lastID):
+	if lastID is None:
+		return lastID
+	errored = ScrapedID.query.filter(ScrapedID.id >= start)\
+	                         .filter(ScrapedID.id <= lastID)\
+	                         .filter(ScrapedID.found.is_(None))\
+	                         .order_by(ScrapedID.id).first()
+	if errored:
+		logging.warning('tournament ' + str(errored.id) + ' could not be '\
+		                'fetched; next run starts there')
+		return errored.id - 1
+	return lastID
+
+# marks a sharded job as finished once none of its shards are left to run
+def finishShardedJob(jobID):
+	shards = ScrapeShard.query.filter_by(job_id=jobID).all()
+	if any(s.status in ['pending', 'running'] for s in shards):
+		return
+
+	job = db.session.get(ScrapeJob, jobID)
+	job.found = sum(s.found or 0 for s in shards)
+	# like scrapeAndNotify, start-1 if nothing was found (HSQB hands out IDs
+	# in order, so empty shards past the last tournament will fill up later)
+	ids = [s.last_id for s in shards if s.found]
+	job.last_id = capLastID(job.start, max(ids) if ids else job.start - 1)
+	failed = [s.id for s in shards if s.status == 'failed']
+	if failed:
+		job.status = 'failed'
+		job.error = 'shards failed: ' + ', '.join(str(i) for i in failed)
+	else:
+		job.status = 'done'
+	job.finished = datetime.now()
+	db.session.commit()
+	logging.info('sharded job ' + str(jobID) + ' ' + job.status)
+
+# returns an error response if the request doesn't have the admin key
+def checkAdminKey():
+	if 'key' not in request.args:
+		return Response('ERROR: no key', mimetype='text/plain'), 400
+
+	if request.args['key'] != mysecrets.admin_key:
+		return Response('ERROR: bad key', mimetype='text/plain'), 401
+
+	return None
+
+# authenticate and queue a scrapeAndNotify job for worker.py
+# the response is the job ID, which can be passed to /sn/status/
 @app.route('/sn/', methods=['GET'])
 def snFrontend():
 	# validate query string
-	if 'key' not in request.args:
-		return Response('ERROR: no key', mimetype='text/plain'), 400
-	
+	err = checkAdminKey()
+	if err: return err
+
 	if 'start' not in request.args:
 		return Response('ERROR: no start index', mimetype='text/plain'), 400
-	
-	if request.args['key'] != mysecrets.admin_key:
-		return Response('ERROR: bad key', mimetype='text/plain'), 401
 
 	try:
 		start = int(request.args['start'])
@@ -471,8 +1645,289 @@ def snFrontend():
 	else:
 		end = 1000000000
 
-	return Response(stream_with_context(scrapeAndNotify(start, end)),
-                        mimetype='text/plain')
+	# how many tournaments to fetch at once
+	workers = app.config['SCRAPE_WORKERS']
+	if 'workers' in request.args:
+		try:
+			workers = int(request.args['workers'])
+		except ValueError:
+			return Response('ERROR: workers must be an integer',
+		                mimetype='text/plain'), 403
+
+	# profile=1 runs the job under the profiler (see profiled)
+	profile = request.args.get('profile', '0') not in ['', '0', 'false']
+
+	job = ScrapeJob(start=start, end=end, workers=workers, profile=profile,
+	                status='queued', created=datetime.now(), found=0)
+	db.session.add(job)
+	db.session.commit()
+	logging.info('queued scrape job ' + str(job.id))
+
+	return Response(str(job.id) + '\n', mimetype='text/plain')
+
+# authenticate and split a big scrape into shards for worker.py (see
+# SHARD_SIZE). takes start, end, and optionally size, workers, and profile
+# the response is the job ID, which can be passed to /sn/status/
+@app.route('/shard/', methods=['GET'])
+def shardFrontend():
+	err = checkAdminKey()
+	if err: return err
+
+	args = {}
+	for name, default in [('start', None), ('end', None),
+	                      ('size', app.config['SHARD_SIZE']),
+	                      ('workers', app.config['SCRAPE_WORKERS'])]:
+		if name not in request.args and default is None:
+			return Response('ERROR: no ' + name + ' index',
+			                mimetype='text/plain'), 400
+		try:
+			args[name] = int(request.args.get(name, default))
+		except ValueError:
+			return Response('ERROR: ' + name + ' must be an integer',
+			                mimetype='text/plain'), 403
+
+	if args['size'] <= 0 or args['end'] < args['start']:
+		return Response('ERROR: empty range', mimetype='text/plain'), 400
+
+	now = datetime.now()
+	profile = request.args.get('profile', '0') not in ['', '0', 'false']
+	job = ScrapeJob(kind='sharded', start=args['start'], end=args['end'],
+	                workers=args['workers'], profile=profile,
+	                status='running', created=now, started=now, found=0)
+	db.session.add(job)
+	db.session.flush()
+
+	for lo in range(args['start'], args['end'] + 1, args['size']):
+		db.session.add(ScrapeShard(job_id=job.id, start=lo,
+		                           end=min(lo + args['size'] - 1, args['end']),
+		                           status='pending', attempts=0, found=0))
+	db.session.commit()
+	logging.info('queued sharded job ' + str(job.id))
+
+	return Response(str(job.id) + '\n', mimetype='text/plain')
+
+# authenticate and queue a rescan of upcoming tournaments for worker.py
+# the response is the job ID, which can be passed to /sn/status/
+@app.route('/rescan/', methods=['GET'])
+def rescanFrontend():
+	err = checkAdminKey()
+	if err: return err
+
+	job = ScrapeJob(kind='rescan', start=0, end=0,
+	                workers=app.config['SCRAPE_WORKERS'],
+	                status='queued', created=datetime.now(), found=0)
+	db.session.add(job)
+	db.session.commit()
+	logging.info('queued rescan job ' + str(job.id))
+
+	return Response(str(job.id) + '\n', mimetype='text/plain')
+
+# progress of a scrape job, as JSON
+@app.route('/sn/status/<int:jobID>', methods=['GET'])
+def snStatus(jobID):
+	err = checkAdminKey()
+	if err: return err
+
+	job = db.session.get(ScrapeJob, jobID)
+	if not job:
+		return Response('ERROR: no such job', mimetype='text/plain'), 404
+
+	status = job.dictify()
+	if job.kind == 'sharded':
+		status['shards'] = [s.dictify() for s in ScrapeShard.query
+		                    .filter_by(job_id=job.id).order_by(ScrapeShard.id)]
+	return jsonify(status)
+
+# every worker's metrics added up, in Prometheus' text format
+@app.route('/metrics', methods=['GET'])
+def metricsEndpoint():
+	err = checkAdminKey()
+	if err: return err
+
+	# only saved snapshots are counted (this process's too, after bringing
+	# it up to date), so the answer doesn't depend on which gunicorn process
+	# gets the request
+	publishChangedMetrics()
+	snaps = []
+	directory = app.config['METRICS_DIR']
+	if os.path.isdir(directory):
+		for name in sorted(os.listdir(directory)):
+			if not name.endswith('.json'): continue
+			path = os.path.join(directory, name)
+			try:
+				if staleProcessFile(path):
+					logging.info('removing stale metrics ' + name)
+					os.remove(path)
+					continue
+				with open(path) as infile:
+					snaps.append(json.load(infile))
+			except (OSError, ValueError) as e:
+				logging.warning('could not read metrics from ' + name + ': '\
+				                + str(e))
+
+	return Response(metrics.render(metrics.merge(snaps)),
+	                mimetype='text/plain; version=0.0.4')
+
+# profiles saved by profiled runs, newest first
+@app.route('/profiles/', methods=['GET'])
+def profileList():
+	err = checkAdminKey()
+	if err: return err
+
+	directory = profileDir()
+	profiles = []
+	for name in os.listdir(directory) if os.path.isdir(directory) else []:
+		if name.startswith('profile-') and name.endswith('.prof'):
+			info = os.stat(os.path.join(directory, name))
+			profiles.append({
+				'name': name,
+				'size': info.st_size,
+				'created': datetime.fromtimestamp(info.st_mtime).isoformat()
+			})
+	profiles.sort(key=lambda p: p['created'], reverse=True)
+
+	return jsonify(profiles)
+
+# download a profile (open it with pstats or snakeviz)
+@app.route('/profiles/<name>', methods=['GET'])
+def profileDownload(name):
+	err = checkAdminKey()
+	if err: return err
+
+	if not (name.startswith('profile-') and name.endswith('.prof')):
+		return Response('ERROR: no such profile', mimetype='text/plain'), 404
+
+	return send_from_directory(
+		profileDir(),
+		name,
+		mimetype='application/octet-stream',
+		as_attachment=True)
+
+# current HSQB rate limits of every worker, as they last published them,
+# keyed by <host>-<pid>
+@app.route('/stats/throttle', methods=['GET'])
+def throttleStats():
+	err = checkAdminKey()
+	if err: return err
+
+	stats = {}
+	directory = app.config['THROTTLE_STATS_DIR']
+	if os.path.isdir(directory):
+		for name in sorted(os.listdir(directory)):
+			if not name.endswith('.json'): continue
+			path = os.path.join(directory, name)
+			try:
+				if staleProcessFile(path):
+					os.remove(path)
+					continue
+				with open(path) as infile:
+					stats[name[:-len('.json')]] = json.load(infile)
+			except (OSError, ValueError) as e:
+				logging.warning('could not read rate limits from ' + name\
+				                + ': ' + str(e))
+
+	return jsonify(stats)
+
+# the map's tournament list, compressed if the browser takes it, and with an
+# ETag so repeat visits only download it when it's changed
+# (this overrides the regular static route for just this file)
+@app.route('/static/upcoming.json', methods=['GET'])
+def upcomingJSON():
+	path = os.path.join(app.root_path, app.config['UPCOMING_FILE'])
+	try:
+		with open(path + '.sha256') as infile:
+			sha = infile.read().strip()
+	except FileNotFoundError:
+		# no scrape has written it yet
+		return jsonify([])
+
+	# each encoding is a different representation, so needs its own ETag
+	accepted = request.accept_encodings
+	if accepted['br'] and os.path.exists(path + '.br'):
+		encoding, suffix = 'br', '.br'
+	elif accepted['gzip']:
+		encoding, suffix = 'gzip', '.gz'
+	else:
+		encoding, suffix = None, ''
+	etag = sha[:32] + ('-' + encoding if encoding else '')
+
+	if request.if_none_match.contains(etag):
+		resp = Response(status=304)
+	else:
+		with open(path + suffix, 'rb') as infile:
+			resp = Response(infile.read(), mimetype='application/json')
+		if encoding:
+			resp.headers['Content-Encoding'] = encoding
+
+	resp.set_etag(etag)
+	resp.headers['Vary'] = 'Accept-Encoding'
+	resp.headers['Cache-Control'] = 'no-cache'
+	return resp
+
+# upcoming tournaments for the map, limited to what's on screen
+# bbox is south,west,north,east; levels is any of MHCOT; from and to are
+# YYYY-MM-DD; below MAP_CLUSTER_ZOOM, nearby tournaments come back as clusters
+@app.route('/api/tournaments', methods=['GET'])
+def tournamentsAPI():
+	try:
+		bbox = [float(x) for x in request.args.get('bbox',
+		                                           '-90,-180,90,180').split(',')]
+	except ValueError:
+		bbox = []
+	if len(bbox) != 4 or not (-90 <= bbox[0] <= bbox[2] <= 90):
+		return Response('ERROR: bbox must be south,west,north,east',
+		                mimetype='text/plain'), 400
+
+	levels = request.args.get('levels', 'MHCOT')
+
+	try:
+		first = request.args.get('from')
+		last = request.args.get('to')
+		if first: datetime.strptime(first, '%Y-%m-%d')
+		if last: datetime.strptime(last, '%Y-%m-%d')
+	except ValueError:
+		return Response('ERROR: dates must be YYYY-MM-DD',
+		                mimetype='text/plain'), 400
+
+	try:
+		zoom = int(request.args['zoom']) if 'zoom' in request.args else None
+	except ValueError:
+		return Response('ERROR: zoom must be an integer',
+		                mimetype='text/plain'), 400
+
+	# longitudes out of range are from a map that's been panned around the
+	# world; a box wider than the world is the whole world
+	south, west, north, east = bbox
+	if east - west >= 360:
+		west, east = -180.0, 180.0
+	else:
+		west = (west + 180) % 360 - 180
+		east = (east + 180) % 360 - 180
+
+	# (ISO dates compare correctly as strings)
+	points = [p for p in mapIndex().query(south, west, north, east)
+	          if p[2]['level'] in levels
+	          and (not first or p[2]['date'] >= first)
+	          and (not last or p[2]['date'] <= last)]
+
+	if zoom is None or zoom >= app.config['MAP_CLUSTER_ZOOM']:
+		return jsonify({'tournaments': [p[2] for p in points], 'clusters': []})
+
+	# a 256 pixel tile spans 360 / 2^zoom degrees of longitude
+	cellSize = app.config['MAP_CLUSTER_PIXELS'] * 360 / (256 * 2**max(zoom, 0))
+	singles = []
+	clusters = []
+	for lat, lon, items in spatial.gridClusters(points, cellSize):
+		if len(items) == 1:
+			singles.append(items[0])
+		else:
+			counts = {}
+			for t in items:
+				counts[t['level']] = counts.get(t['level'], 0) + 1
+			clusters.append({'lat': lat, 'lon': lon, 'count': len(items),
+			                 'levels': counts})
+
+	return jsonify({'tournaments': singles, 'clusters': clusters})
 
 # certain static files
 @app.route('/robots.txt')
@@ -497,27 +1952,6 @@ def browserconfig():
 		'browserconfig.xml',
 		mimetype='application/xml')
 
-# finds great-circle distance between 2 points on a sphere
-# (Yes, I know the earth is an oblate spheroid, but I'm not going to implement
-#  the full Vincenty formula to give you <0.5% more accurate geodesics. It was
-#  hard enough making sure this was numerically well-conditioned. Just make your
-#  notifcation circle slightly larger if it matters to you.)
-def surfDist(r, latlon1, latlon2):
-	# convert to radians
-	lat1 = latlon1[0] * math.pi / 180
-	lon1 = latlon1[1] * math.pi / 180
-	lat2 = latlon2[0] * math.pi / 180
-	lon2 = latlon2[1] * math.pi / 180
-
-	# haversine formula
-	# (possibly not super well-conditioned for antipodes, but if you want to
-	#  notified exclusively about non-antipodal tournaments, you have bigger
-	#  problems)
-	tmp = math.sin((lat1 - lat2) / 2)**2 \
-	      + math.cos(lat1) * math.cos(lat2) * math.sin((lon1 - lon2) / 2)**2
-
-	return 2 * r * math.asin(math.sqrt(tmp))
-
 if __name__ == '__main__':
 	# this is only for debugging, not deployment
 	app.run()
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+
+# reparses every archived tournament page (see archive.py) without touching
+# the network, and prints what the parser makes of each one. handy for seeing
+# what a parser change does to the historical data
+# with -compare, each page is parsed both the fast way and the old way (see
+# scraper.parseTournament), and only the tournaments where they disagree are
+# printed
+# with -samples, the pages in samples/ are used instead of the archive (see
+# samples/README), so -compare -samples works on a fresh checkout
+# usage: ./reparse.py [-j PROCESSES] [-compare] [-samples] [START [END]]
+
+import logging
+import multiprocessing
+import os
+import sys
+
+import archive
+import scraper
+
+SAMPLES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           'samples')
+
+# set in each pool process by useSamples
+_samples = False
+
+def useSamples(samples):
+	global _samples
+	_samples = samples
+
+def sampleIDs():
+	return sorted(int(name[:-len('.html')]) for name in os.listdir(SAMPLES_DIR)
+	              if name.endswith('.html'))
+
+# the archived page or GPX file of a tournament, or None
+def load(tid, kind):
+	if not _samples:
+		return archive.load(tid, kind)
+
+	path = os.path.join(SAMPLES_DIR, str(tid) + ('.html' if kind == 'page'
+	                                             else '.gpx'))
+	try:
+		with open(path, encoding='utf-8') as infile:
+			return infile.read()
+	except FileNotFoundError:
+		return None
+
+def parse(tid, fast=True):
+	try:
+		t = scraper.parseTournament(tid, load(tid, 'page'),
+		                            lambda: load(tid, 'gpx') or '',
+		                            offline=True, fast=fast)
+	except Exception:
+		logging.exception('parser failed on tournament ' + str(tid))
+		return (tid, None)
+
+	if not t:
+		return (tid, None)
+	return (tid, [t.level, t.state, t.date.strftime('%Y-%m-%d'),
+	              t.position[0], t.position[1], t.name])
+
+def compare(tid):
+	return (tid, parse(tid)[1], parse(tid, fast=False)[1])
+
+if __name__ == '__main__':
+	args = sys.argv[1:]
+	processes = multiprocessing.cpu_count()
+	if args[:1] == ['-j']:
+		processes = int(args[1])
+		args = args[2:]
+
+	comparing = (args[:1] == ['-compare'])
+	if comparing:
+		args = args[1:]
+
+	samples = (args[:1] == ['-samples'])
+	if samples:
+		args = args[1:]
+
+	start = int(args[0]) if len(args) > 0 else 1
+	end = int(args[1]) if len(args) > 1 else 1000000000
+
+	logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s',
+	                    level=logging.WARNING)
+
+	useSamples(samples)
+	tids = [tid for tid in (sampleIDs() if samples
+	                        else archive.tournamentIDs())
+	        if start <= tid <= end]
+	what = 'sample' if samples else 'archived'
+	parsed = 0
+	with multiprocessing.Pool(processes, useSamples, (samples,)) as pool:
+		if comparing:
+			differ = 0
+			for tid, fast, slow in pool.imap(compare, tids, chunksize=32):
+				if fast != slow:
+					differ += 1
+					print(str(tid) + '\tfast: ' + str(fast))
+					print(str(tid) + '\told:  ' + str(slow))
+
+			print(str(differ) + ' of ' + str(len(tids)) + ' ' + what
+			      + ' tournaments parse differently', file=sys.stderr)
+			sys.exit(1 if differ else 0)
+
+		for tid, info in pool.imap(parse, tids, chunksize=32):
+			if info:
+				parsed += 1
+				print(str(tid) + '\t' + '\t'.join(str(x) for x in info))
+			else:
+				print(str(tid) + '\tNone')
+
+	print('parsed ' + str(parsed) + ' of ' + str(len(tids)) + ' ' + what
+	      + ' tournaments', file=sys.stderr)
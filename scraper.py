@@ -1,19 +1,55 @@
 #!/usr/bin/env python3
 
+import hashlib
 import json
 import logging
 import math
 import re
 import requests
 import sys
+import time
+import xml.etree.ElementTree as ET
 
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from urllib.parse import urlparse
 
 from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
+import archive
+import geocache
+import metrics
 import mysecrets
+import spatial
+import throttle
 from constants import states
 
+# lxml parses pages many times faster than beautifulsoup does, so we use it
+# directly when it's installed
+try:
+	import lxml.html
+except ImportError:
+	lxml = None
+
+# where we get our data from
+HSQB_URL = 'http://hsquizbowl.org/db/tournaments/'
+GEOCODE_URL = 'https://maps.googleapis.com/maps/api/geocode/json'
+
+# (connect, read) timeouts for every request, in seconds
+HTTP_TIMEOUT = (5, 30)
+
+# failed connections and responses with these codes are retried this many
+# times, waiting HTTP_BACKOFF * 2^n seconds before the nth retry
+HTTP_RETRIES = 4
+HTTP_BACKOFF = 0.5
+HTTP_RETRY_STATUSES = [429, 500, 502, 503, 504]
+
+# max keep-alive connections per host (should be at least SCRAPE_WORKERS)
+HTTP_POOL_SIZE = 32
+
 class Tournament:
 	id = None
 	name = None
@@ -22,15 +58,101 @@ class Tournament:
 	state = None
 	position = None
 
-def geocode(address):
+# how long each stage takes (see metrics.py)
+pageTime = metrics.histogram('qbnotify_hsqb_page_seconds',
+                             'Time to fetch a tournament page from HSQB')
+gpxTime = metrics.histogram('qbnotify_hsqb_gpx_seconds',
+                            'Time to fetch a GPX file from HSQB')
+geocodeTime = metrics.histogram('qbnotify_geocode_seconds',
+                                'Time for a geocoding API request')
+geocodeHits = metrics.counter('qbnotify_geocode_cache_hits_total',
+                              'Geocoding queries answered from the cache')
+geocodeMisses = metrics.counter('qbnotify_geocode_cache_misses_total',
+                                'Geocoding queries not in the cache')
+parsePageTime = metrics.histogram('qbnotify_parse_page_seconds',
+                                  'Time to parse a tournament page')
+parseGPXTime = metrics.histogram('qbnotify_parse_gpx_seconds',
+                                 'Time to parse a GPX file')
+httpRetries = metrics.counter('qbnotify_http_retries_total',
+                              'Requests retried after a 429 or 5xx')
+
+# all requests go through one session, so connections to each host are pooled
+# and kept alive instead of doing a handshake for every page
+# (urllib3 retries connection errors; httpGet retries bad statuses itself so
+#  the rate limiter gets to see them)
+def _makeSession():
+	retry = Retry(total=HTTP_RETRIES,
+	              backoff_factor=HTTP_BACKOFF,
+	              status_forcelist=[],
+	              allowed_methods=['GET'])
+	adapter = HTTPAdapter(pool_maxsize=HTTP_POOL_SIZE, max_retries=retry)
+
+	session = requests.Session()
+	session.mount('http://', adapter)
+	session.mount('https://', adapter)
+	return session
+
+session = _makeSession()
+
+# GET with our default timeout, retry policy, and rate limits (see throttle.py)
+# raises requests.RequestException if the host is still unreachable after
+# retrying; 429/5xx responses are returned once retries run out
+def httpGet(url, **kwargs):
+	kwargs.setdefault('timeout', HTTP_TIMEOUT)
+	limiter = throttle.forHost(urlparse(url).hostname)
+
+	for attempt in range(HTTP_RETRIES + 1):
+		if limiter: limiter.acquire()
+		start = time.monotonic()
+		resp = None
+		try:
+			resp = session.get(url, **kwargs)
+		finally:
+			# whatever happened, the slot has to be given back (a failed
+			# request counts as trouble)
+			if limiter and resp is None:
+				limiter.release(None, time.monotonic() - start)
+			elif limiter:
+				limiter.release(resp.status_code, time.monotonic() - start,
+				                resp.headers.get('Retry-After'))
+
+		if resp.status_code not in HTTP_RETRY_STATUSES\
+		   or attempt == HTTP_RETRIES:
+			return resp
+
+		httpRetries.inc()
+
+		# (don't log the query string, it can have our API key in it)
+		parsed = urlparse(url)
+		logging.warning('got HTTP ' + str(resp.status_code) + ' from '\
+		                + parsed.netloc + parsed.path + '; retrying')
+		time.sleep(HTTP_BACKOFF * 2**attempt)
+
+# if cacheOnly is set, only previously cached results are returned
+def geocode(address, cacheOnly=False):
+	# addresses repeat a lot, so check the cache first
+	cached, result = geocache.lookup(address)
+	if cached:
+		geocodeHits.inc()
+		logging.info('geocode cache hit: ' + address)
+		return result
+	elif cacheOnly:
+		return None
+	geocodeMisses.inc()
+
 	logging.info('Google maps query: ' + address)
-	baseURL = 'https://maps.googleapis.com/maps/api/geocode/json'
-	reqURL = baseURL\
+	reqURL = GEOCODE_URL\
 	         + '?address=' + address.replace(' ', '+')\
 	         + '&key=' + mysecrets.maps_server_api_key
 
 	# do query and check for errors
-	resp = requests.get(reqURL)
+	try:
+		with geocodeTime.time():
+			resp = httpGet(reqURL)
+	except requests.RequestException as e:
+		logging.error('could not reach geocoding API: ' + str(e))
+		return None
+
 	if resp.status_code != 200:
 		logging.error('geocoding API returned HTTP status code '\
 		              + str(resp.status_code)\
@@ -42,6 +164,9 @@ def geocode(address):
 	if retObj['status'] != 'OK':
 		logging.warning('geocoding API returned ' + retObj['status']\
 		                + ' (query was ' + reqURL + ')')
+		# only remember definite failures, not quota or key problems
+		if retObj['status'] == 'ZERO_RESULTS':
+			geocache.store(address, None)
 		return None
 
 	# get coordinates
@@ -63,8 +188,10 @@ def geocode(address):
 				break
 	else:
 		place = 'other'
-	
-	return [location['lat'], location['lng'], place]
+
+	result = [location['lat'], location['lng'], place]
+	geocache.store(address, result)
+	return result
 
 # try to extract state from address
 def addr2state(address):
@@ -81,30 +208,147 @@ def addr2state(address):
 	# nothing found
 	return ''
 
+# whether an error status means HSQB is having trouble (so asking again
+# later could work), rather than that there's nothing there for us
+def isTransient(status):
+	return status == 429 or status >= 500
+
 # gets info for a specific tournament in HSQB's database
-def getTournament(tid):
-	tourney = Tournament()
-	tourney.id = tid
-	
-	resp = requests.get('http://hsquizbowl.org/db/tournaments/' + str(tid))
+# everything fetched is saved in the archive. if offline is set, the archived
+# copies are parsed instead, and geocoding only uses cached results
+def getTournament(tid, offline=False):
+	if offline:
+		pageText = archive.load(tid, 'page')
+		if pageText is None:
+			logging.info('tournament ' + str(tid) + ' is not archived')
+			return None
+
+		def getGPX():
+			return archive.load(tid, 'gpx') or ''
+
+		return parseTournament(tid, pageText, getGPX, offline=True)
+
+	with pageTime.time():
+		resp = httpGet(HSQB_URL + str(tid))
+	if isTransient(resp.status_code):
+		# not the same as a missing tournament, so let the caller know
+		raise requests.HTTPError('HTTP status code ' + str(resp.status_code)\
+		                         + ' for tournament ' + str(tid), response=resp)
 	if resp.status_code != 200:
-		logging.error('could not get tournament ' + str(tid)\
-		              + ' from HSQB. HTTP status code '\
-		              + str(resp.status_code))
+		# 404, 403, 410, ... won't get any better by asking again
+		logging.info('could not get tournament ' + str(tid)\
+		             + ' from HSQB. HTTP status code '\
+		             + str(resp.status_code))
 		return None
+	archive.store(tid, 'page', resp.text)
+
+	# the GPX file is only fetched if the page is worth looking at
+	def getGPX():
+		with gpxTime.time():
+			respGPX = httpGet(HSQB_URL + str(tid) + '/gpx')
+		if respGPX.status_code == 200:
+			archive.store(tid, 'gpx', respGPX.text)
+		elif isTransient(respGPX.status_code):
+			raise requests.HTTPError('HTTP status code '\
+			                         + str(respGPX.status_code)\
+			                         + ' for GPX of tournament ' + str(tid),
+			                         response=respGPX)
+		return respGPX.text
+
+	return parseTournament(tid, resp.text, getGPX)
+
+# returns the (lat, lon) strings of the first waypoint in a GPX file, or None
+# the XML is read in chunks and we stop at the first waypoint, so no tree is
+# built. anything that isn't valid XML (like an error page) goes through the
+# old lenient path instead
+def gpxWaypoint(text, chunkSize=4096):
+	data = text.encode('utf-8')
+	parser = ET.XMLPullParser(events=('start',))
+	try:
+		for k in range(0, len(data), chunkSize):
+			parser.feed(data[k:k + chunkSize])
+			for event, elem in parser.read_events():
+				# tags come with the GPX namespace attached
+				if elem.tag == 'wpt' or elem.tag.endswith('}wpt'):
+					return (elem.attrib['lat'], elem.attrib['lon'])
+		parser.close()
+	except ET.ParseError:
+		return _gpxWaypointSoup(text)
+
+	return None
+
+# how we used to find the waypoint: parse the whole file as HTML
+def _gpxWaypointSoup(text):
+	wpt = BeautifulSoup(text, features='html.parser').select_one('wpt')
+	if wpt:
+		return (wpt['lat'], wpt['lon'])
+	return None
+
+# the parts of a tournament page we care about, as
+# (is an error page, name, level/date heading, [(field label, field text)])
+# name and heading are None if they're missing
+def _readPage(pageText):
+	# class selectors, the way CSS does them
+	def cls(name):
+		return '[contains(concat(" ", normalize-space(@class), " "), " '\
+		       + name + ' ")]'
+
+	# lxml won't take a str with an encoding declaration, so give it bytes
+	parser = lxml.html.HTMLParser(encoding='utf-8')
+	root = lxml.html.document_fromstring(pageText.encode('utf-8'), parser)
+
+	isError = bool(root.xpath('//*' + cls('FBError')))
+	names = root.xpath('(//*' + cls('MultilineHeading') + '//h2)[1]')
+	headings = root.xpath('(//*' + cls('MultilineHeading') + '//h5)[1]')
+	fields = [(f.text_content(), f.getparent().text_content())
+	          for f in root.xpath('//*' + cls('FieldName'))]
+
+	return (isError,
+	        names[0].text_content() if names else None,
+	        headings[0].text_content() if headings else None,
+	        fields)
+
+# same as _readPage, but with beautifulsoup (which is how we used to do it)
+def _readPageSoup(pageText):
+	soup = BeautifulSoup(pageText, features="html.parser")
+
+	name = soup.select_one('.MultilineHeading h2')
+	heading = soup.select_one('.MultilineHeading h5')
+	fields = [(f.text, f.parent.text) for f in soup.select('.FieldName')]
+
+	return (soup.select_one('.FBError') is not None,
+	        name.text if name else None,
+	        heading.text if heading else None,
+	        fields)
+
+# extracts tournament info from the HTML of its page. getGPX is called with no
+# arguments to get the text of its GPX file, if we need it. offline is passed
+# on to geocode as cacheOnly. if fast isn't set, we parse the way we used to
+# (a full soup for both the page and the GPX), to check that the fast way
+# gives the same answers
+def parseTournament(tid, pageText, getGPX, offline=False, fast=True):
+	tourney = Tournament()
+	tourney.id = tid
 
-	soup = BeautifulSoup(resp.text, features="html.parser")
+	with parsePageTime.time():
+		if fast and lxml:
+			isError, name, ldate, fields = _readPage(pageText)
+		else:
+			isError, name, ldate, fields = _readPageSoup(pageText)
 
 	# tournament does not exist
-	if soup.select_one('.FBError'):
+	if isError:
 		logging.info('tournament ' + str(tid) + ' does not exist')
 		return None
 
+	if name is None or ldate is None:
+		logging.warn('no heading for tournament ' + str(tid) + '; ignoring')
+		return None
+
 	# tournament name is in first h2 in heading
-	tourney.name = soup.select_one('.MultilineHeading h2').text
+	tourney.name = name
 
 	# date is formatted as $LEVEL tournament on $DATE
-	ldate = soup.select_one('.MultilineHeading h5').text
 	datesplit = ldate.split(' tournament on ')
 	if len(datesplit) < 2:
 		# not listed, we can't use this
@@ -124,16 +368,15 @@ def getTournament(tid):
 		datestr += datesplit[1][-6:]
 
 	# get address, if present
-	fnames = soup.select('.FieldName')
-	addrs = [f.parent for f in fnames if f.text == 'Address:']
-	locs = [f.parent for f in fnames if f.text == 'Host location:']
+	addrs = [text for label, text in fields if label == 'Address:']
+	locs = [text for label, text in fields if label == 'Host location:']
 
-	if locs: hloc = locs[0].text.replace('Host location: ', '')
+	if locs: hloc = locs[0].replace('Host location: ', '')
 	else: hloc = ''
 
 	if addrs:
 		# has an 'Address' field
-		addr = addrs[0].text.replace('Address: ', '')
+		addr = addrs[0].replace('Address: ', '')
 	elif locs:
 		# otherwise, we use the 'Host location' field
 		addr = hloc
@@ -154,22 +397,30 @@ def getTournament(tid):
 		addr = ''
 	
 	# check if coordinates are listed
-	respGPX = requests.get('http://hsquizbowl.org/db/tournaments/'\
-	                       + str(tid) + '/gpx')
-	soupGPX = BeautifulSoup(respGPX.text, features="html.parser")
-	
-	wpt = soupGPX.select_one('wpt')
+	gpxText = getGPX()
+	with parseGPXTime.time():
+		if fast:
+			wpt = gpxWaypoint(gpxText)
+		else:
+			wpt = _gpxWaypointSoup(gpxText)
 
 	if wpt:
 		# we have coordinates!
-		lat = wpt['lat']
-		lon = wpt['lon']
+		lat, lon = wpt
 		place = addr2state(addr)
 
-		# if no state/province is mentioned in address, see if we can
-		# geocode it. we try this last to conserve API queries
+		# if no state/province is mentioned in address, look up which one
+		# the coordinates are in. we only ask google if our own boundary data
+		# doesn't know, to conserve API queries
 		if not place:
-			place = geocode(str(lat) + ', ' + str(lon))[2]
+			place = spatial.resolveState(float(lat), float(lon))
+		if not place:
+			location = geocode(str(lat) + ', ' + str(lon), offline)
+			if not location:
+				logging.warn('could not find state for tournament '\
+				             + str(tid) + '; ignoring')
+				return None
+			place = location[2]
 	elif addr.lower() in ['internet', 'the internet', 'online', 'cloud',
 	                      'the cloud', 'skype', 'discord', 'zoom']:
 		# online tournament are their own thing
@@ -185,10 +436,10 @@ def getTournament(tid):
 			return None
 		
 		# we now have an address string, which we can try to geocode
-		location = geocode(addr)
+		location = geocode(addr, offline)
 		if not location and hloc and hloc != addr:
 			# 'Address' gc failed, try 'Host Location' as a last resort
-			location = geocode(hloc)
+			location = geocode(hloc, offline)
 
 		if location:
 			[lat, lon, place] = location
@@ -211,8 +462,99 @@ def getTournament(tid):
 		
 	return tourney
 
-def getAllTournaments(start=1, end=1000000000):
-	resp = requests.get('http://hsquizbowl.org/db/tournaments/dbstats.php')
+# checks whether a tournament's page or GPX file has changed since we last
+# looked. validators are what the previous call returned (or None): the ETag
+# and Last-Modified headers of both files, and a hash of their contents
+# returns (tourney, validators), where tourney is None if nothing changed (or
+# the tournament can't be parsed anymore)
+def rescanTournament(tid, validators=None):
+	old = validators or {}
+	urls = {'page': HSQB_URL + str(tid), 'gpx': HSQB_URL + str(tid) + '/gpx'}
+
+	# conditional GETs, so unchanged files cost a 304 and no body
+	resps = {}
+	for kind in urls:
+		headers = {}
+		if old.get(kind + '_etag'):
+			headers['If-None-Match'] = old[kind + '_etag']
+		if old.get(kind + '_modified'):
+			headers['If-Modified-Since'] = old[kind + '_modified']
+		with (pageTime if kind == 'page' else gpxTime).time():
+			resps[kind] = httpGet(urls[kind], headers=headers)
+
+	if all(r.status_code == 304 for r in resps.values()):
+		return (None, validators)
+
+	# something changed, so we need both bodies after all
+	for kind in urls:
+		if resps[kind].status_code == 304:
+			with (pageTime if kind == 'page' else gpxTime).time():
+				resps[kind] = httpGet(urls[kind])
+
+	if resps['page'].status_code != 200:
+		logging.error('could not rescan tournament ' + str(tid)\
+		              + '. HTTP status code '\
+		              + str(resps['page'].status_code))
+		return (None, validators)
+
+	new = {}
+	for kind in urls:
+		new[kind + '_etag'] = resps[kind].headers.get('ETag')
+		new[kind + '_modified'] = resps[kind].headers.get('Last-Modified')
+	new['hash'] = hashlib.sha256(resps['page'].content + b'\0'
+	                             + resps['gpx'].content).hexdigest()
+
+	# servers that don't do conditional GETs still get caught here
+	if new['hash'] == old.get('hash'):
+		return (None, new)
+
+	archive.store(tid, 'page', resps['page'].text)
+	if resps['gpx'].status_code == 200:
+		archive.store(tid, 'gpx', resps['gpx'].text)
+
+	return (parseTournament(tid, resps['page'].text,
+	                        lambda: resps['gpx'].text), new)
+
+# fetches a single tournament, logging (but not raising) parser failures
+# IDs that couldn't be fetched at all are added to failed (if given), since
+# unlike missing tournaments they should be tried again later
+def _fetchTournament(tid, offline=False, failed=None):
+	try:
+		return getTournament(tid, offline)
+	except requests.RequestException as e:
+		# we already retried, so HSQB or google is actually down
+		logging.error('could not fetch tournament ' + str(tid)\
+		              + ' after retrying: ' + str(e))
+		if failed is not None:
+			failed.add(tid)
+		return None
+	except Exception:
+		logging.exception('parser failed on tournament ' + str(tid))
+		return None
+
+# yields all tournaments with IDs in [start, end], in ascending order of ID,
+# except for IDs in skip (which aren't fetched at all)
+# if workers > 1, up to that many tournaments are fetched at once. results are
+# still yielded in order, so callers can treat the last ID seen as a checkpoint
+# if offline is set, archived tournaments are parsed instead (see getTournament)
+# if failed is a set, IDs whose fetch errored are added to it. by the time a
+# tournament is yielded, every lower ID that failed is already in there
+def getAllTournaments(start=1, end=1000000000, workers=1, skip=(),
+                      offline=False, failed=None):
+	if offline:
+		tids = [tid for tid in archive.tournamentIDs()
+		        if start <= tid <= end and tid not in skip]
+		if workers > 1:
+			return _getConcurrently(tids, workers, True, failed)
+		else:
+			return _getSequentially(tids, True, failed)
+
+	try:
+		resp = httpGet(HSQB_URL + 'dbstats.php')
+	except requests.RequestException as e:
+		logging.error('could not get DB stats from HSQB: ' + str(e))
+		return []
+
 	if resp.status_code != 200:
 		logging.error('could not get DB stats from HSQB. HTTP status code '\
 		              + str(resp.status_code))
@@ -220,22 +562,57 @@ def getAllTournaments(start=1, end=1000000000):
 
 	try:
 		maxID = int(re.search(r'(?<=max=)[0-9]+', resp.text).group(0))
-	except:
+	except AttributeError:
 		logging.error('could not parse DB stats from HSQB')
 		return []
 
-	for tid in range(max(start,1), min(end,maxID) + 1):
+	tids = [tid for tid in range(max(start,1), min(end,maxID) + 1)
+	        if tid not in skip]
+	if workers > 1:
+		return _getConcurrently(tids, workers, failed=failed)
+	else:
+		return _getSequentially(tids, failed=failed)
+
+def _getSequentially(tids, offline=False, failed=None):
+	for tid in tids:
+		info = _fetchTournament(tid, offline, failed)
+		if info:
+			logging.info('got tournament ' + str(tid))
+			yield info
+
+def _getConcurrently(tids, workers, offline=False, failed=None):
+	# we keep a bounded window of pending fetches rather than submitting the
+	# whole range at once, so a huge backfill doesn't queue millions of futures
+	window = 4 * workers
+	pending = deque()
+	tidIter = iter(tids)
+
+	with ThreadPoolExecutor(max_workers=workers) as pool:
 		try:
-			info = getTournament(tid)
-		except KeyboardInterrupt:
-			# user pressed ctrl-C, exit immediately
-			raise
-		except:
-			logging.error('parser failed on tournament ' + str(tid))
-		else:
-			if info:
-				logging.info('got tournament ' + str(tid))
-				yield info
+			for tid in tidIter:
+				future = pool.submit(_fetchTournament, tid, offline, failed)
+				pending.append((tid, future))
+				if len(pending) < window:
+					continue
+
+				# window is full, wait for the oldest fetch
+				tid, future = pending.popleft()
+				info = future.result()
+				if info:
+					logging.info('got tournament ' + str(tid))
+					yield info
+
+			# drain whatever is left
+			while pending:
+				tid, future = pending.popleft()
+				info = future.result()
+				if info:
+					logging.info('got tournament ' + str(tid))
+					yield info
+		finally:
+			# if the consumer stops early, don't bother with the rest
+			for tid, future in pending:
+				future.cancel()
 
 if __name__ == '__main__':
 	for t in getAllTournaments(start=4900, end=4950):
@@ -0,0 +1,325 @@
+#!/usr/bin/env python3
+
+# geometry that we can do locally instead of asking google
+
+import json
+import logging
+import math
+import os
+
+from constants import states
+
+# numpy is only needed for batch matching on big backfills
+try:
+	import numpy as np
+except ImportError:
+	np = None
+
+# mean radius of the earth in meters
+EARTH_RADIUS = 6371008.8
+
+# state/province/country boundaries, one GeoJSON file per code in
+# constants.states (these are the same files the map draws)
+BOUNDARY_DIR = 'static/geojson'
+
+# finds which state, province, or country a point is in, using the boundary
+# files above. regions are bucketed into a coarse lat/lon grid, and each
+# region's edges are bucketed into thin latitude bands, so a lookup only runs
+# the crossing test on the handful of edges at the point's latitude
+class StateResolver:
+	def __init__(self, directory=BOUNDARY_DIR, cellSize=1.0, bandSize=0.05):
+		self.cellSize = cellSize
+		self.bandSize = bandSize
+		self.grid = {}
+		self.regions = {}
+
+		if not os.path.isdir(directory):
+			logging.warning('no boundary data in ' + directory\
+			                + '; all state lookups will use the API')
+			return
+
+		codes = [s[1] for s in states if s[1] not in ['Online', 'other']]
+		for code in codes:
+			path = os.path.join(directory, code + '.json')
+			if not os.path.exists(path):
+				continue
+
+			with open(path) as infile:
+				rings = _geojsonRings(json.load(infile))
+			if rings:
+				self._addRegion(code, rings)
+
+		logging.info('loaded boundaries for ' + str(len(self.regions))\
+		             + ' states/provinces')
+
+	def _addRegion(self, code, rings):
+		bands = {}
+		minLat = minLon = math.inf
+		maxLat = maxLon = -math.inf
+
+		for ring in rings:
+			for k in range(len(ring)):
+				lon1, lat1 = ring[k - 1][0], ring[k - 1][1]
+				lon2, lat2 = ring[k][0], ring[k][1]
+
+				minLat = min(minLat, lat1)
+				maxLat = max(maxLat, lat1)
+				minLon = min(minLon, lon1)
+				maxLon = max(maxLon, lon1)
+
+				# horizontal edges never cross a horizontal ray
+				if lat1 == lat2: continue
+
+				edge = (lon1, lat1, lon2, lat2)
+				lo = math.floor(min(lat1, lat2) / self.bandSize)
+				hi = math.floor(max(lat1, lat2) / self.bandSize)
+				for b in range(lo, hi + 1):
+					bands.setdefault(b, []).append(edge)
+
+		self.regions[code] = ((minLat, minLon, maxLat, maxLon), bands)
+
+		for i in range(math.floor(minLat / self.cellSize),
+		               math.floor(maxLat / self.cellSize) + 1):
+			for j in range(math.floor(minLon / self.cellSize),
+			               math.floor(maxLon / self.cellSize) + 1):
+				self.grid.setdefault((i, j), []).append(code)
+
+	# returns the code of the region containing (lat, lon), or None
+	def resolve(self, lat, lon):
+		cell = (math.floor(lat / self.cellSize),
+		        math.floor(lon / self.cellSize))
+
+		for code in self.grid.get(cell, []):
+			(minLat, minLon, maxLat, maxLon), bands = self.regions[code]
+			if not (minLat <= lat <= maxLat and minLon <= lon <= maxLon):
+				continue
+
+			# even-odd rule with a ray going east (holes are just more rings)
+			inside = False
+			for lon1, lat1, lon2, lat2 in \
+			    bands.get(math.floor(lat / self.bandSize), []):
+				if (lat1 > lat) != (lat2 > lat):
+					cross = lon1 + (lat - lat1) * (lon2 - lon1) / (lat2 - lat1)
+					if lon < cross:
+						inside = not inside
+
+			if inside:
+				return code
+
+		return None
+
+# flattens any GeoJSON object into a list of linear rings
+def _geojsonRings(obj):
+	kind = obj.get('type')
+	if kind == 'FeatureCollection':
+		return [r for f in obj['features'] for r in _geojsonRings(f)]
+	elif kind == 'Feature':
+		return _geojsonRings(obj['geometry']) if obj['geometry'] else []
+	elif kind == 'GeometryCollection':
+		return [r for g in obj['geometries'] for r in _geojsonRings(g)]
+	elif kind == 'Polygon':
+		return obj['coordinates']
+	elif kind == 'MultiPolygon':
+		return [r for poly in obj['coordinates'] for r in poly]
+	return []
+
+# boundaries are loaded the first time they're needed
+_resolver = None
+
+def resolveState(lat, lon):
+	global _resolver
+	if _resolver is None:
+		_resolver = StateResolver()
+	return _resolver.resolve(lat, lon)
+
+# finds great-circle distance between 2 points on a sphere
+# (Yes, I know the earth is an oblate spheroid, but I'm not going to implement
+#  the full Vincenty formula to give you <0.5% more accurate geodesics. It was
+#  hard enough making sure this was numerically well-conditioned. Just make your
+#  notifcation circle slightly larger if it matters to you.)
+def surfDist(r, latlon1, latlon2):
+	# convert to radians
+	lat1 = latlon1[0] * math.pi / 180
+	lon1 = latlon1[1] * math.pi / 180
+	lat2 = latlon2[0] * math.pi / 180
+	lon2 = latlon2[1] * math.pi / 180
+
+	# haversine formula
+	# (possibly not super well-conditioned for antipodes, but if you want to
+	#  notified exclusively about non-antipodal tournaments, you have bigger
+	#  problems)
+	tmp = math.sin((lat1 - lat2) / 2)**2 \
+	      + math.cos(lat1) * math.cos(lat2) * math.sin((lon1 - lon2) / 2)**2
+
+	return 2 * r * math.asin(math.sqrt(tmp))
+
+# converts a notification radius to meters
+def toMeters(radius, unit):
+	if unit == 'mi': return radius * 1609.3
+	elif unit == 'ft': return radius * 0.3048
+	elif unit == 'km': return radius * 1000.0
+	else: return radius
+
+# buckets circles (center + radius in meters) into a lat/lon grid, so that a
+# point only needs to be tested against circles whose bounding box covers its
+# cell. query() may return circles that don't actually contain the point, but
+# never misses one that does, so callers still do the exact distance test
+class CircleIndex:
+	def __init__(self, cellSize=1.0):
+		self.cellSize = cellSize
+		self.cols = math.ceil(360 / cellSize)
+		self.grid = {}
+
+	def _col(self, lon):
+		return math.floor(((lon + 180) % 360) / self.cellSize) % self.cols
+
+	def add(self, lat, lon, radius, item):
+		if radius is None or radius < 0:
+			return
+
+		# angular radius, plus a little slack for rounding
+		d = radius / EARTH_RADIUS
+		slack = 1e-6
+		dLat = math.degrees(d) + slack
+
+		latLo = max(lat - dLat, -90)
+		latHi = min(lat + dLat, 90)
+		rows = range(math.floor(latLo / self.cellSize),
+		             math.floor(latHi / self.cellSize) + 1)
+
+		# widest longitude difference inside a spherical cap
+		# (if the cap covers a pole, every longitude is in range)
+		cosLat = math.cos(math.radians(lat))
+		if latLo <= -90 or latHi >= 90 or math.sin(d) >= cosLat:
+			cols = range(self.cols)
+		else:
+			dLon = math.degrees(math.asin(math.sin(d) / cosLat)) + slack
+			if 2 * dLon >= 360:
+				cols = range(self.cols)
+			else:
+				first = self._col(lon - dLon)
+				count = math.floor((lon + dLon) / self.cellSize)\
+				        - math.floor((lon - dLon) / self.cellSize) + 1
+				cols = [(first + k) % self.cols
+				        for k in range(min(count, self.cols))]
+
+		entry = (item, radius)
+		for i in rows:
+			for j in cols:
+				self.grid.setdefault((i, j), []).append(entry)
+
+	# returns (item, radius) for every circle that might contain (lat, lon)
+	def query(self, lat, lon):
+		return self.grid.get((math.floor(lat / self.cellSize),
+		                      self._col(lon)), [])
+
+# unit vectors for a list of (lat, lon) in degrees, one per row
+def _unitVectors(latlons):
+	ll = np.radians(np.array(latlons, dtype=float).reshape(-1, 2))
+	cosLat = np.cos(ll[:, 0])
+	return np.column_stack((cosLat * np.cos(ll[:, 1]),
+	                        cosLat * np.sin(ll[:, 1]),
+	                        np.sin(ll[:, 0])))
+
+# finds every (point, circle) pair where the point is inside the circle, for
+# many points at once. points and centers are lists of (lat, lon), radii are in
+# meters. if pointClass and allowed are given, pair (i, j) is only considered
+# when allowed[pointClass[i]][j] is true (we use this for difficulty levels).
+#
+# the haversine term in surfDist, sin^2(dlat/2) + cos*cos*sin^2(dlon/2), is
+# equal to (1 - p.c)/2 for unit vectors p and c, so a whole block of points is
+# done with one matrix multiply and compared against sin^2(radius/2r) without
+# any trig. pairs close enough to the boundary for rounding to matter are
+# rechecked with surfDist, so the result is exactly what the scalar test would
+# give. points are done blockSize at a time to bound memory. requires numpy
+def batchWithin(r, points, centers, radii, pointClass=None, allowed=None,
+                blockSize=1024):
+	pairs = []
+	if not points or not centers:
+		return pairs
+
+	pVec = _unitVectors(points)
+	cVec = _unitVectors(centers).T
+
+	# circles bigger than half the globe contain everything
+	half = np.minimum(np.array(radii, dtype=float) / (2 * r), math.pi / 2)
+	thresh = np.sin(half)**2
+	thresh[half >= math.pi / 2] = 2.0
+
+	# pairs below tight are certainly inside and pairs above loose certainly
+	# aren't; only the sliver in between is rechecked
+	tight = thresh * (1 - 1e-9) - 1e-12
+	loose = thresh * (1 + 1e-9) + 1e-12
+
+	if allowed is not None:
+		allowed = np.asarray(allowed, dtype=bool)
+		pointClass = np.asarray(pointClass, dtype=int)
+
+	for lo in range(0, len(points), blockSize):
+		hav = (1 - pVec[lo:lo + blockSize] @ cVec) / 2
+
+		inside = hav < tight
+		edge = (hav < loose) & ~inside
+		if allowed is not None:
+			wanted = allowed[pointClass[lo:lo + blockSize]]
+			inside &= wanted
+			edge &= wanted
+
+		for i, j in zip(*np.nonzero(inside)):
+			pairs.append((int(i) + lo, int(j)))
+
+		for i, j in zip(*np.nonzero(edge)):
+			i = int(i) + lo
+			j = int(j)
+			if surfDist(r, centers[j], points[i]) < radii[j]:
+				pairs.append((i, j))
+
+	return pairs
+
+# buckets points into a lat/lon grid for bounding box queries (the map only
+# asks for what's on screen)
+class PointIndex:
+	def __init__(self, cellSize=1.0):
+		self.cellSize = cellSize
+		self.grid = {}
+		self.size = 0
+
+	def _cell(self, lat, lon):
+		return (math.floor(lat / self.cellSize),
+		        math.floor(lon / self.cellSize))
+
+	def add(self, lat, lon, item):
+		self.grid.setdefault(self._cell(lat, lon), []).append((lat, lon, item))
+		self.size += 1
+
+	# returns (lat, lon, item) for every point in the box. if west > east, the
+	# box crosses the antimeridian
+	def query(self, south, west, north, east):
+		if west > east:
+			return self.query(south, west, north, 180.0)\
+			       + self.query(south, -180.0, north, east)
+
+		# a big box is cheaper to do by looking at every cell
+		(lo, left), (hi, right) = self._cell(south, west),\
+		                          self._cell(north, east)
+		if (hi - lo + 1) * (right - left + 1) > len(self.grid):
+			cells = [pts for (i, j), pts in self.grid.items()
+			         if lo <= i <= hi and left <= j <= right]
+		else:
+			cells = [self.grid.get((i, j), []) for i in range(lo, hi + 1)
+			         for j in range(left, right + 1)]
+
+		return [p for pts in cells for p in pts
+		        if south <= p[0] <= north and west <= p[1] <= east]
+
+# groups (lat, lon, item) points that fall in the same cellSize-degree grid
+# cell. returns (mean lat, mean lon, [items]) for each group
+def gridClusters(points, cellSize):
+	cells = {}
+	for lat, lon, item in points:
+		key = (math.floor(lat / cellSize), math.floor(lon / cellSize))
+		cells.setdefault(key, []).append((lat, lon, item))
+
+	return [(sum(p[0] for p in pts) / len(pts),
+	         sum(p[1] for p in pts) / len(pts),
+	         [p[2] for p in pts]) for pts in cells.values()]
@@ -6,9 +6,6 @@ colorDefaults = {
     fillOpacity: 0.3
 };
 
-// map markers for each level of tournament
-markerSublists = { M: [], H: [], C: [], O: [], T: [] };
-
 function initMap() {
     map = new google.maps.Map(document.getElementById('map'), {
         zoom: 4,
@@ -52,37 +49,86 @@ function initMap() {
       }
     );
 
-    // markers for upcoming tournaments
-    getJSON(
-        document.location.origin + '/static/upcoming.json',
-        function(tournaments) {
-            var levelDict = { M: 'Middle school', H: 'High school', C: 'College',
-                              O: 'Open', T: 'Trash' };
-
-            infWindow = new google.maps.InfoWindow();
-            tournaments.forEach(function(t) {
-                var marker = new google.maps.Marker({
-                    // jiggle so overlapping markers are visible
-                    position: {lat: t.lat + 0.0002 * (Math.random() - 0.5),
-                               lng: t.lon + 0.0002 * (Math.random() - 0.5)},
-                    map: map,
-                    title: t.name,
-                    icon: '/static/markers/' + t.level + '.png'
-                });
-
-                markerSublists[t.level].push(marker);
-
-                // pull up description when marker is clicked
-                marker.addListener('click', function() {
-                    var cont = '<a href="http://hsquizbowl.org/db/tournaments/'+t.id+'">'
-                        + t.name + '</a><br />'
-                        + levelDict[t.level] + ' tournament on ' + t.date;
-                    infWindow.setContent(cont);
-                    infWindow.open(map, marker);
-                });
-            });
-        }
+    // markers for upcoming tournaments, fetched for whatever is on screen
+    // whenever the map stops moving
+    infWindow = new google.maps.InfoWindow();
+    map.addListener('idle', loadMarkers);
+}
+
+var levelDict = { M: 'Middle school', H: 'High school', C: 'College',
+                  O: 'Open', T: 'Trash' };
+
+// markers (and cluster markers) currently on the map
+var markers = [];
+
+// so a slow response for an old view doesn't replace a newer one
+var markerRequest = 0;
+
+function loadMarkers() {
+    var bounds = map.getBounds();
+    if (!bounds) {
+        return;
+    }
+    var sw = bounds.getSouthWest();
+    var ne = bounds.getNorthEast();
+
+    var levels = '';
+    [].forEach.call(
+      document.querySelectorAll('#levelboxes input:checked'),
+      function(box) { levels += box.name; }
     );
+
+    var url = document.location.origin + '/api/tournaments'
+        + '?bbox=' + [sw.lat(), sw.lng(), ne.lat(), ne.lng()].join(',')
+        + '&levels=' + levels
+        + '&zoom=' + map.getZoom();
+
+    var request = ++markerRequest;
+    getJSON(url, function(result) {
+        if (request !== markerRequest) {
+            return;
+        }
+
+        markers.forEach(function(m) { m.setMap(null); });
+        markers = [];
+
+        result.tournaments.forEach(function(t) {
+            var marker = new google.maps.Marker({
+                // jiggle so overlapping markers are visible
+                position: {lat: t.lat + 0.0002 * (Math.random() - 0.5),
+                           lng: t.lon + 0.0002 * (Math.random() - 0.5)},
+                map: map,
+                title: t.name,
+                icon: '/static/markers/' + t.level + '.png'
+            });
+            markers.push(marker);
+
+            // pull up description when marker is clicked
+            marker.addListener('click', function() {
+                var cont = '<a href="http://hsquizbowl.org/db/tournaments/'+t.id+'">'
+                    + t.name + '</a><br />'
+                    + levelDict[t.level] + ' tournament on ' + t.date;
+                infWindow.setContent(cont);
+                infWindow.open(map, marker);
+            });
+        });
+
+        // clusters zoom in when clicked
+        result.clusters.forEach(function(c) {
+            var marker = new google.maps.Marker({
+                position: {lat: c.lat, lng: c.lon},
+                map: map,
+                title: c.count + ' tournaments',
+                label: String(c.count)
+            });
+            markers.push(marker);
+
+            marker.addListener('click', function() {
+                map.setCenter(marker.getPosition());
+                map.setZoom(map.getZoom() + 2);
+            });
+        });
+    });
 }
 
 // JSON XHR wrapper for convenience
@@ -113,6 +159,5 @@ function drawState(abbr) {
 }
 
 function checkFunc(box) {
-    var markers = markerSublists[box.getAttribute('name')];
-    markers.forEach(function(m) { m.setVisible(box.checked); });
+    loadMarkers();
 }
@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+
+# keeps us from hammering hsquizbowl.org. each limited host gets a token bucket
+# (requests per second) and a cap on requests in flight. both grow slowly
+# while the host answers quickly, and get cut in half when it returns 429/5xx,
+# errors out, or gets slow (AIMD, like TCP congestion control)
+# the limits are per process, so processes scraping at the same time each
+# take their share of them (see setShare)
+
+import threading
+import time
+
+# settings for each host we limit; anything not listed here isn't limited
+LIMITS = {
+	'hsquizbowl.org': {
+		'rate': 4.0,          # starting requests per second
+		'minRate': 0.25,
+		'maxRate': 20.0,
+		'concurrency': 4,     # starting requests in flight
+		'maxConcurrency': 16,
+		'slow': 3.0,          # responses slower than this (s) count as trouble
+	},
+}
+
+class HostLimiter:
+	def __init__(self, rate, minRate, maxRate, concurrency, maxConcurrency,
+	             slow):
+		self.rate = rate
+		self.minRate = minRate
+		self.maxRate = maxRate
+		self.concurrency = float(concurrency)
+		self.maxConcurrency = maxConcurrency
+		self.slow = slow
+
+		# the limits as configured, before taking our share (see setShare)
+		self.limits = (minRate, maxRate, maxConcurrency)
+		self.share = 1.0
+
+		# allow a burst of about a second's worth of requests
+		self.tokens = 1.0
+		self.refilled = time.monotonic()
+		self.inFlight = 0
+
+		# after cutting back, we wait a bit before cutting again, so one bad
+		# moment doesn't get counted once for every request in flight
+		self.lastCut = 0.0
+		self.blockedUntil = 0.0
+
+		self.requests = 0
+		self.cuts = 0
+		self.latency = None
+
+		self.cond = threading.Condition()
+
+	def _refill(self, now):
+		self.tokens = min(max(self.rate, 1.0),
+		                  self.tokens + (now - self.refilled) * self.rate)
+		self.refilled = now
+
+	# blocks until we're allowed to send a request
+	def acquire(self):
+		with self.cond:
+			while True:
+				now = time.monotonic()
+				self._refill(now)
+				if now >= self.blockedUntil and self.tokens >= 1\
+				   and self.inFlight < int(self.concurrency):
+					self.tokens -= 1
+					self.inFlight += 1
+					self.requests += 1
+					return
+
+				if now < self.blockedUntil:
+					wait = self.blockedUntil - now
+				elif self.tokens < 1:
+					wait = (1 - self.tokens) / self.rate
+				else:
+					wait = None # woken up by release()
+				self.cond.wait(wait)
+
+	# reports how a request went. status is the HTTP status code, or None if
+	# the request failed outright. retryAfter is the Retry-After header
+	def release(self, status, latency, retryAfter=None):
+		with self.cond:
+			self.inFlight -= 1
+			now = time.monotonic()
+
+			if self.latency is None: self.latency = latency
+			else: self.latency = 0.9 * self.latency + 0.1 * latency
+
+			if status is None or status == 429 or status >= 500\
+			   or latency > self.slow:
+				if now - self.lastCut > max(1.0, self.latency):
+					self.rate = max(self.minRate, self.rate / 2)
+					self.concurrency = max(1.0, self.concurrency / 2)
+					self.lastCut = now
+					self.cuts += 1
+
+				# the server told us exactly how long to back off
+				if status == 429 and retryAfter:
+					try:
+						self.blockedUntil = now + float(retryAfter)
+					except ValueError:
+						pass
+			else:
+				# one extra request per second (and in flight) per round
+				self.rate = min(self.maxRate, self.rate + 1 / self.rate)
+				self.concurrency = min(self.maxConcurrency,
+				                       self.concurrency + 1 / self.concurrency)
+
+			self.cond.notify_all()
+
+	# scales the limits down to share of what's configured, and pulls the
+	# current rate and concurrency under them
+	def setShare(self, share):
+		with self.cond:
+			minRate, maxRate, maxConcurrency = self.limits
+			self.share = share
+			self.minRate = minRate * share
+			self.maxRate = maxRate * share
+			self.maxConcurrency = max(1, int(maxConcurrency * share))
+			self.rate = max(self.minRate, min(self.maxRate, self.rate))
+			self.concurrency = min(float(self.maxConcurrency),
+			                       self.concurrency)
+			self.cond.notify_all()
+
+	def stats(self):
+		with self.cond:
+			return {
+				'share': round(self.share, 3),
+				'rate': round(self.rate, 3),
+				'concurrency': int(self.concurrency),
+				'in_flight': self.inFlight,
+				'requests': self.requests,
+				'cutbacks': self.cuts,
+				'latency': round(self.latency, 3) if self.latency else None,
+			}
+
+_limiters = {}
+_lock = threading.Lock()
+
+# fraction of each host's limits this process gets
+_share = 1.0
+
+# the limiter for a host, or None if it isn't limited
+def forHost(host):
+	if host not in LIMITS:
+		return None
+
+	with _lock:
+		if host not in _limiters:
+			_limiters[host] = HostLimiter(**LIMITS[host])
+			_limiters[host].setShare(_share)
+		return _limiters[host]
+
+# gives this process share (0 to 1) of every host's limits. with n processes
+# scraping at once, each taking 1/n keeps the total about where one process
+# on its own would be
+def setShare(share):
+	global _share
+	with _lock:
+		_share = share
+		for limiter in _limiters.values():
+			limiter.setShare(share)
+
+# current settings and counters for every host we've talked to
+def stats():
+	with _lock:
+		return {host: l.stats() for host, l in _limiters.items()}
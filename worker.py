@@ -0,0 +1,37 @@
+#!/usr/bin/env python3
+
+# runs scrape jobs queued through /sn, so scraping and emailing don't tie up
+# the web server, and retries emails that couldn't be sent. start as many of
+# these as you like next to gunicorn. when there's no job, it helps with
+# shards of a job queued through /shard (workers on other hosts can too, if
+# they share the DB)
+# usage: ./worker.py [-dbg] [-profile]
+# (-profile runs every job under the profiler, see qbnotify.profiled)
+
+import logging
+import time
+
+from qbnotify import app, db, claimJob, runJob, claimShard, runShard, \
+                     deliverOutbox, publishStats
+
+# seconds to wait between checks when the queue is empty
+POLL_INTERVAL = 10
+
+if __name__ == '__main__':
+	logging.info('started worker')
+	with app.app_context():
+		while True:
+			job = claimJob()
+			shard = None if job else claimShard()
+			if job:
+				runJob(job)
+			elif shard:
+				runShard(shard)
+			elif not deliverOutbox():
+				time.sleep(POLL_INTERVAL)
+
+			# keep /metrics up to date (emails sent from the outbox, mostly)
+			publishStats()
+
+			# don't hold on to stale objects between jobs
+			db.session.remove()